@@ -1,8 +1,11 @@
 import tkinter
 from tkinter.scrolledtext import ScrolledText
 import WormCSV
-import re
+import WormRun
 import threading
+import queue
+import collections
+import time
 
 """The WormBaitUI module holds the custom classes that make up the user interface layer in WormBait
 
@@ -18,18 +21,40 @@ class ConsoleBox (ScrolledText):
     keyboard shortcuts. Some methods are publicly exposed to make writing text
     more accessible to other components. This class is used both as the input and
     the output text in the final UI
+
+    Tk may only be touched from the thread running the main loop. Other threads
+    (like the one performing a run) must use post() and postln() instead of
+    write() and writeln(). Posted text is queued, and the main loop drains the
+    queue a few times a second, inserting everything posted since the last
+    drain in one go. Text that would only scroll straight out of the capped
+    scrollback is dropped before it ever reaches the widget, so a drain costs
+    the same however fast text is posted.
     """
+
+    POLL_INTERVAL = 100
+    """Milliseconds between drains of the posted text"""
+
+    CLEAR = object()
+    """Posted in place of text to clear the box. See postClear()"""
     
-    def __init__(self, parent, height=25):
+    def __init__(self, parent, height=25, maxLines=None):
         """Constructs the ConsoleBox object.
 
         Most of the heavy lifting is done by the superconstructor, but
         we also perform the shortcut binding here.
+
+        Arguments:
+        parent -- the Tk parent widget
+        height -- the height of the box, in lines
+        maxLines -- the most lines of scrollback kept. Older lines are deleted. None for no limit
         """
         
         ScrolledText.__init__(self, parent, width=80, height=height)
         self.bindShortcuts()
         self.parent = parent
+        self.maxLines = maxLines
+        self.posted = queue.Queue()
+        self.after(self.POLL_INTERVAL, self.drain)
 
     def bindShortcuts (self):
         """Creates shortcuts for Windows and OSX to highlight all text in the box"""
@@ -52,6 +77,60 @@ class ConsoleBox (ScrolledText):
         """Wipes the text from the ConsoleBox"""
         self.delete('1.0', 'end')
 
+    def post (self, text):
+        """Queues text to be written to the ConsoleBox. Safe to call from any thread. Does not terminate with a newline"""
+        self.posted.put(text)
+
+    def postln (self, text):
+        """Queues text to be written to the ConsoleBox. Safe to call from any thread. Terminates with a newline"""
+        self.posted.put(text + '\n')
+
+    def postClear (self):
+        """Queues a clear() of the ConsoleBox. Safe to call from any thread"""
+        self.posted.put(self.CLEAR)
+
+    def drain (self):
+        """Writes everything posted since the last drain in a single insert, then schedules the next drain
+
+        Runs on the Tk main loop every POLL_INTERVAL milliseconds.
+        """
+        pieces = []
+        cleared = False
+        while True:
+            try:
+                item = self.posted.get_nowait()
+            except queue.Empty:
+                break
+            if item is self.CLEAR:
+                pieces = []
+                cleared = True
+            else:
+                pieces.append(item)
+
+        if cleared:
+            self.clear()
+
+        if pieces:
+            text = ''.join(pieces)
+
+            # Only the last maxLines lines of the batch can survive the cap, so
+            # there is no point handing the rest to the widget
+            if self.maxLines and text.count('\n') > self.maxLines:
+                text = '\n'.join(text.split('\n')[-self.maxLines - 1:])
+
+            self.insert(tkinter.END, text)
+            self.trim()
+            self.see(tkinter.END)
+
+        self.after(self.POLL_INTERVAL, self.drain)
+
+    def trim (self):
+        """Deletes the oldest lines, if there are more than maxLines"""
+        if self.maxLines:
+            lines = int(self.index('end-1c').split('.')[0])
+            if lines > self.maxLines:
+                self.delete('1.0', '%d.0' % (lines - self.maxLines + 1))
+
     def getValue (self):
         """Gets all of the text in the ConsoleBox"""
         return self.get('1.0', 'end-1c')
@@ -63,8 +142,150 @@ class ConsoleBox (ScrolledText):
         self.see(tkinter.INSERT)
         return 'break'
 
+class ProgressPanel (tkinter.Frame):
+    """The panel under the Process button that shows how the current run is going
+
+    A run reports to a WormRun.RunStats and paces its requests through the
+    transport's WormNet.AdaptiveLimiter. The panel reads both a few times a
+    second, from the Tk main loop, and shows the stage the run is at, the genes
+    done so far, genes and requests per second, the requests in flight, the
+    cache hit rate, the errors and an estimate of the time left. The rates are
+    taken over the last RATE_WINDOW seconds, so a run that is being throttled or
+    has stalled shows it within a few seconds.
+
+    The thread performing the run only sets plain attributes (see start(),
+    setStage(), rowWritten() and finish()); it never touches Tk itself.
+    """
+
+    REFRESH_INTERVAL = 250
+    """Milliseconds between refreshes of the panel"""
+
+    RATE_WINDOW = 10.0
+    """Seconds of history the rates and the ETA are worked out over"""
+
+    def __init__ (self, parent):
+        """Constructs a ProgressPanel showing no run
+
+        Arguments:
+        parent -- the Tk parent widget
+        """
+        tkinter.Frame.__init__(self, parent)
+        self.parent = parent
+        self.stats = None
+        self.limiter = None
+        self.stage = 'Idle'
+        self.written = 0
+        self.finished = False
+        self.samples = collections.deque()
+        self.buildContent()
+        self.after(self.REFRESH_INTERVAL, self.refresh)
+
+    def buildContent (self):
+        """Lays out the label and value of each figure, in three rows of three"""
+        self.values = {}
+        names = ['Stage', 'Genes', 'Written', 'Genes/s', 'ETA', 'Requests/s', 'In flight', 'Cache hits', 'Errors']
+        for i, name in enumerate(names):
+            row, column = divmod(i, 3)
+            tkinter.Label(self, text=name + ':').grid(row=row, column=column * 2, sticky='E')
+            self.values[name] = tkinter.StringVar(value='-')
+            tkinter.Label(self, textvariable=self.values[name], width=16, anchor='w').grid(row=row, column=column * 2 + 1,
+                                                                                           sticky='W')
+
+    def start (self, stats, limiter):
+        """Starts showing a new run. Safe to call from any thread
+
+        Arguments:
+        stats -- the WormRun.RunStats the run reports to
+        limiter -- the WormNet.AdaptiveLimiter its requests go through
+        """
+        self.samples = collections.deque()
+        self.written = 0
+        self.finished = False
+        self.limiter = limiter
+        self.stats = stats
+
+    def finish (self, stage):
+        """Stops following the run once the figures have been brought up to date. Safe to call from any thread
+
+        Arguments:
+        stage -- what to show as the stage from now on, e.g. 'Finished'
+        """
+        self.stage = stage
+        self.finished = True
+
+    def setStage (self, stage):
+        """Sets the short description of what the run is doing, e.g. 'Collecting'. Safe to call from any thread"""
+        self.stage = stage
+
+    def rowWritten (self):
+        """Counts one row written to the output. Called only by the thread performing the run"""
+        self.written += 1
+
+    def refresh (self):
+        """Updates every figure from the run's stats, then schedules the next refresh
+
+        Runs on the Tk main loop every REFRESH_INTERVAL milliseconds.
+        """
+        self.values['Stage'].set(self.stage)
+        stats, limiter = self.stats, self.limiter
+        if stats:
+            self.show(stats.progress(), limiter)
+            if self.finished:
+                self.stats = None
+        self.after(self.REFRESH_INTERVAL, self.refresh)
+
+    def show (self, progress, limiter):
+        """Sets the figures from one RunStats.progress() sample, and the limiter's current state"""
+        now = time.time()
+        self.samples.append((now, progress['genes'], progress['network']))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.RATE_WINDOW:
+            self.samples.popleft()
+
+        # Rates over the window, not the whole run, so a slowdown shows straight away
+        then, genesThen, networkThen = self.samples[0]
+        elapsed = now - then
+        genesPerSecond = (progress['genes'] - genesThen) / elapsed if elapsed else 0.0
+        requestsPerSecond = (progress['network'] - networkThen) / elapsed if elapsed else 0.0
+
+        expected = progress['expectedGenes']
+        if expected is None:
+            self.values['Genes'].set(str(progress['genes']))
+        else:
+            self.values['Genes'].set('%d / %d' % (progress['genes'], expected))
+        self.values['Written'].set(str(self.written))
+        self.values['Genes/s'].set('%.1f' % genesPerSecond)
+        self.values['Requests/s'].set('%.1f' % requestsPerSecond)
+
+        if expected is not None and progress['genes'] >= expected:
+            self.values['ETA'].set('0:00:00')
+        elif self.stage == 'Paused':
+            self.values['ETA'].set('paused')
+        elif expected is not None and genesPerSecond > 0:
+            self.values['ETA'].set(self.formatSeconds((expected - progress['genes']) / genesPerSecond))
+        elif elapsed >= self.RATE_WINDOW:
+            self.values['ETA'].set('stalled')
+        else:
+            self.values['ETA'].set('-')
+
+        if limiter:
+            self.values['In flight'].set('%d (limit %d)' % (limiter.inFlight, limiter.currentLimit()))
+        if progress['requests']:
+            self.values['Cache hits'].set('%.0f%%' % (100.0 * progress['cacheHits'] / progress['requests']))
+        else:
+            self.values['Cache hits'].set('-')
+        self.values['Errors'].set(str(progress['errors']))
+
+    def formatSeconds (self, seconds):
+        """Formats a number of seconds as h:mm:ss"""
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return '%d:%02d:%02d' % (hours, minutes, seconds)
+
 class ProcessButton (tkinter.Button):
     """The ProcessButton is the component that kicks off the run of WormBait. Extends Tkinter.Button"""
+
+    MAX_FAILURES_SHOWN = 20
+    """The most failed requests listed in the console at the end of a run"""
     
     def __init__(self, parent):
         """Constructs a ProcessButton.
@@ -74,19 +295,85 @@ class ProcessButton (tkinter.Button):
         
         tkinter.Button.__init__(self, parent, text="Process", command=self.OnClick)
         self.parent = parent
+        self.thread = None
+        self.run = None
+        self.cancelRequested = False
+        self.pauseText = tkinter.StringVar(value='Pause')
 
     def OnClick (self, *ignore):
-        """Kicks off a thread that performs the WormBait run"""
-        
-        t = threading.Thread(target=self.process)
-        t.start()
+        """Kicks off a thread that performs the WormBait run, unless one is already going"""
+        if self.running():
+            self.logln('A run is already in progress. Cancel it first to start another')
+            return
+
+        self.run = None
+        self.cancelRequested = False
+        self.pauseText.set('Pause')
+        self.thread = threading.Thread(target=self.process, args=(self.readSettings(),))
+        self.thread.start()
+
+    def readSettings (self):
+        """Returns everything the run needs from the window, as plain values
+
+        Tk may only be used from the main loop, so the run's thread is handed
+        these rather than reading the window's variables itself.
+        """
+        return {'ids': self.parent.entryList.getValue(),
+                'dbFilePath': self.parent.dbFilePath.get(),
+                'outFilePath': self.parent.outFilePath.get(),
+                'fields': self.parent.selectedFields(),
+                'incremental': self.parent.incremental.get(),
+                'profile': self.parent.profile.get()}
+
+    def running (self):
+        """Identifies whether a run is in progress"""
+        return self.thread is not None and self.thread.is_alive()
+
+    def OnPauseClick (self, *ignore):
+        """Pauses the run in progress, or resumes it if it is paused. Bound to the Pause button
+
+        A paused run sends no new requests, but keeps its connections and
+        everything fetched so far, so resuming carries on where it stopped.
+        """
+        run = self.run
+        if not self.running() or run is None or run.cancelled:
+            return
+
+        if self.pauseText.get() == 'Pause':
+            run.pause()
+            self.pauseText.set('Resume')
+            self.parent.progress.setStage('Paused')
+            self.logln('Run paused')
+        else:
+            run.resume()
+            self.pauseText.set('Pause')
+            self.parent.progress.setStage('Collecting')
+            self.logln('Run resumed')
+
+    def OnCancelClick (self, *ignore):
+        """Cancels the run in progress. Bound to the Cancel button
+
+        The rows finished so far are written, and the journal is kept, so
+        pressing Process again resumes the run rather than starting over.
+        """
+        if not self.running() or self.cancelRequested:
+            return
+
+        # If the run hasn't been built yet, processRun() cancels it as soon as it is
+        self.cancelRequested = True
+        if self.run:
+            self.run.cancel()
+        self.pauseText.set('Pause')
+        self.parent.progress.setStage('Cancelling')
+        self.logln('Cancelling the run...')
 
     def log (self, text):
         """Convenience method to write text to the parent UI's ConsoleBox
 
-        Writes text to the parent's console without a newline terminator
+        Writes text to the parent's console without a newline terminator. The run
+        doesn't happen on the Tk thread, so the text is posted rather than written
         """
-        self.parent.console.write(text)
+        self.parent.console.post(text)
 
     def logln (self, text):
         """Convenience method to write text to the parent UI's ConsoleBox
@@ -96,40 +383,57 @@ class ProcessButton (tkinter.Button):
         self.log(text + '\n')
 
     def collect_db_ids (self, rawText):
-        """Collects and scrubs the DB IDs from the input console
-
-        After some effort, the IDs can now be separated by any combination of
-        newlines and commas. Whitespace is stripped from beginning and end
-        """
-        dbIds = rawText.split('\n') # Split up rows
-        dbIds = [re.compile("[ ,]").split(i) for i in dbIds] # Split apart rows by spaces
-        dbIds = [i for sublist in dbIds for i in sublist] # Flatten sublists into one level
-        cleanIds = [x.strip() for x in dbIds] # Remove whitespace from each ID
-        cleanIds = [_f for _f in cleanIds if _f] # Remove all empty IDs
-        return cleanIds
+        """Collects and scrubs the DB IDs from the input console. See WormRun.collect_db_ids"""
+        return WormRun.collect_db_ids(rawText)
 
     def check_db_ids (self, db_ids):
-        """Identifies whether or not ALL of the DB IDs provided are WormBase gene IDs.
+        """Identifies whether or not ALL of the DB IDs provided are WormBase gene IDs. See WormRun.check_db_ids"""
+        return WormRun.check_db_ids(db_ids)
+        
+    def process (self, settings):
+        """Performs the 'run' of WormBait, profiling it if 'Profile runs' is ticked in the Run menu
+
+        The profile is saved next to the output file, as <output>.prof (for pstats
+        or a viewer) and <output>.profile.txt (the slowest functions, as text).
 
-        If every provided ID is a WormBase gene ID, WormBait will skip reading a provided
-        database file (since no DB will be needed to connect a DB ID to a WormBase gene ID).
+        Arguments:
+        settings -- the window's settings, as read by readSettings() when Process was clicked
         """
-        exclusively_WB_IDs = True;
+        progress = self.parent.progress
+        progress.setStage('Starting')
+        try:
+            self.processProfiled(settings)
+        finally:
+            # A run that returned early or raised never reached 'Finished'
+            if progress.stage not in ('Finished', 'Cancelled'):
+                progress.finish('Stopped')
+
+    def processProfiled (self, settings):
+        """Performs the 'run' of WormBait under the profiler, if 'Profile runs' is ticked. See process()"""
+        if not settings['profile']:
+            self.processRun(settings)
+            return
 
-        for x in db_ids:
-            if not 'WBGene' in x:
-                exclusively_WB_IDs = False
-                break
+        outFilePath = settings['outFilePath']
+        profiler = WormRun.RunProfiler()
+        profiler.start()
+        try:
+            self.processRun(settings)
+        finally:
+            profiler.stop()
 
-        return exclusively_WB_IDs
-        
-    def process (self):
+            # A run that didn't get as far as having an output file has no profile worth keeping
+            if outFilePath and not outFilePath.startswith('Enter'):
+                profilePath, summaryPath = profiler.save(outFilePath)
+                self.logln('\nProfile written to %s (summary in %s)' % (profilePath, summaryPath))
+
+    def processRun (self, settings):
         """Performs the 'run' of WormBait - collects all data from WormBase and writes it to the output file"""
-        self.parent.console.clear()
+        self.parent.console.postClear()
 
         # First, some error handling. The input console needs some number of XLOC IDs
         # to perform a run
-        listEntryText = self.parent.entryList.getValue()
+        listEntryText = settings['ids']
         if not str(listEntryText) or str(listEntryText).startswith('Enter'):
             self.logln('Please enter some number of DB IDs')
             return
@@ -138,74 +442,133 @@ class ProcessButton (tkinter.Button):
         noDbMode = self.check_db_ids(cleanIds)
 
         # The CuffLink database file path must be specified
+        dbFilePath = settings['dbFilePath']
         if not noDbMode:
-            dbFilePath = self.parent.dbFilePath.get()
             if not dbFilePath or dbFilePath.startswith('Enter'):
                 self.logln('Please choose a path to the database file')
                 return
             else:
-                self.parent.console.writeln('Database file located at: ' + self.parent.dbFilePath.get())
+                self.logln('Database file located at: ' + dbFilePath)
         else:
-            self.parent.console.writeln('WormBase gene IDs specified exclusively. No database file required')
+            self.logln('WormBase gene IDs specified exclusively. No database file required')
 
         # The desired output file path must be specified
-        outFilePath = self.parent.outFilePath.get()
+        outFilePath = settings['outFilePath']
         if not outFilePath or outFilePath.startswith('Enter'):
             self.logln('Please choose a path to the output file')
             return
         else:
-            self.parent.console.writeln('Writing output CSV to: ' + outFilePath)
+            self.logln('Writing output to: ' + outFilePath)
 
         self.logln('Processing...')
         
         # Build the object representing the CuffLink DB
         if not noDbMode:
-            with open(self.parent.dbFilePath.get(), 'r') as csvDatabaseFile:
-                self.csvDatabase = WormCSV.CuffLinkDatabase(csvDatabaseFile)
-
-        # Initialize the list of WormData objects
-        allWormDatas = []
+            self.parent.progress.setStage('Reading database')
+            self.csvDatabase = WormCSV.openDatabase(dbFilePath)
 
-        
         self.logln('Beginning data collection from WormBase (this could take a bit)')
 
-        # This loop contains all of the WormBase API interactions
-        for id in cleanIds:
-            self.log(id + ' ... ')
-
-            if not noDbMode and id.startswith("XLOC"):
-                wormbaseIDs = self.csvDatabase.get(id)['gene'].split(',')
-                xlocMode = True
+        # The run engine contains all of the WormBase API interactions. It collects
+        # several genes at once, so IDs are reported as they finish, not in order
+        if noDbMode:
+            database = None
+        else:
+            database = self.csvDatabase
+        # Every finished gene is also kept in a journal next to the output. If
+        # this run dies, pressing Process again picks up where it left off
+        fields = settings['fields']
+        journal = WormRun.RunJournal(outFilePath + '.journal', cleanIds, fields, None if noDbMode else dbFilePath)
+        if journal.completed:
+            self.logln('Resuming: %d genes already collected by an earlier attempt' % len(journal.completed))
+
+        # In incremental mode, genes already in the output file are kept and only
+        # the missing ones are fetched
+        previous = None
+        if settings['incremental']:
+            previous = WormCSV.openPreviousOutput(outFilePath, self.parent.maxAge, fields)
+            self.logln('Reusing %d rows from the existing output file' % len(previous.rows))
+
+        # Every request is counted and timed, for the report at the end
+        stats = WormRun.RunStats()
+        run = WormRun.WormBaitRun(cleanIds, database, self.parent.workers,
+                                  self.parent.backend, self.parent.concurrency, self.parent.transport,
+                                  self.parent.cache, journal=journal, previous=previous, fields=fields,
+                                  strategy=self.parent.strategy, stats=stats)
+        self.run = run
+        if self.cancelRequested:
+            run.cancel()
+
+        # Rows are written to the output as soon as they (and every row before
+        # them) are finished, so a run that dies partway still leaves its
+        # results so far on disk
+        # The progress panel follows the run from here on
+        progress = self.parent.progress
+        progress.start(stats, self.parent.transport.limiter)
+        progress.setStage('Collecting')
+
+        # An incremental run reads the output it is replacing, so the new one is
+        # staged beside it and only takes its place once the run is complete
+        output = WormCSV.openOutput(outFilePath, run.headers(), staged=previous is not None)
+        output.start(run.hasDbIds())
+        complete = False
+        try:
+            try:
+                for wormData in run.results(lambda id: self.logln(id + ' ... finished')):
+                    output.writeRow(wormData)
+                    progress.rowWritten()
+                complete = not run.cancelled
+            finally:
+                output.finish(complete)
+        except:
+            journal.close()
+            raise
+        else:
+            # The last rows only reach the output in finish(), so the journal is kept
+            # until that has succeeded. A cancelled run keeps its journal too, so the
+            # next Process picks up from it
+            if complete:
+                journal.remove()
             else:
-                wormbaseIDs = [id]
-                xlocMode = False
-
-            for i in wormbaseIDs:
-                # Create the WormData object. The object populates its own data in its constructor
-
-                if xlocMode:
-                    d = WormCSV.WormData(id, i, self.csvDatabase)
-                    d.data['db_id'] = id
-                else:
-                    d = WormCSV.WormData(None, i, None)
-                    
-                allWormDatas.append(d)
-            
-            self.logln('finished')
-
-        self.logln('Finished collecting data from WormBase')
-
-        # This list of headers can be subject to change in the future. For now,
-        # it is fixed
-        headers = ['db_id', 'gene_id', 'up/down', 'sequence_name', 'protein_id', 
-                   'best_human_ortholog', 'description', 'gene_class', 'human_orthologs',
-                   'nematode_orthologs', 'other_orthologs']
-
-        self.log('Writing output CSV file ... ')
-        output = WormCSV.OutputCSV(outFilePath, headers)
-        output.write(allWormDatas)
-        self.logln('finished!')
+                journal.close()
+            if previous and complete:
+                previous.keepAge(outFilePath)
+        finally:
+            if database:
+                database.close()
+
+        if run.cancelled and previous:
+            self.logln('Run cancelled. The output file was left as it was; press Process to resume')
+        elif run.cancelled:
+            self.logln('Run cancelled. %d rows were written; press Process to resume' % progress.written)
+        else:
+            self.logln('Finished collecting data from WormBase')
+
+        # Summarise the requests made, and keep the full report next to the output
+        progress.setStage('Writing report')
+        stats.finish()
+        for line in stats.lines():
+            self.logln(line)
+        stats.write(outFilePath + '.report.json', {'ids': len(cleanIds), 'backend': run.backend,
+                                                   'strategy': self.parent.strategy, 'fields': fields,
+                                                   'failures': len(run.failures), 'cancelled': run.cancelled})
+        self.logln('Run report written to ' + outFilePath + '.report.json')
+
+        # The requests a cancel stopped are not worth listing as failures
+        if run.cancelled:
+            progress.finish('Cancelled')
+            return
+
+        # Requests that failed even after retrying leave blank fields. Say which,
+        # so they aren't mistaken for data WormBase doesn't have
+        if run.failures:
+            self.logln('%d requests failed; their fields are blank in the output:' % len(run.failures))
+            for geneID, failure in run.failures[:self.MAX_FAILURES_SHOWN]:
+                self.logln('  %s %s/%s: %s' % (geneID, failure['id'], failure['endpoint'], failure['reason']))
+            if len(run.failures) > self.MAX_FAILURES_SHOWN:
+                self.logln('  ... and %d more' % (len(run.failures) - self.MAX_FAILURES_SHOWN))
         self.log('Run complete!')
+        progress.finish('Finished')
 
 class AboutWindow (tkinter.Toplevel):
     """The window with the 'About WormBait' information
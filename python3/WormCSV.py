@@ -1,7 +1,14 @@
 import csv
-import requests
+import os
+import mmap
+import hashlib
+import sqlite3
+import threading
+import time
+import WormNet
 import json
 import sys
+import concurrent.futures
 
 """The WormCSV module holds classes that make up the infrastructure of the data layer in WormBait
 
@@ -16,38 +23,222 @@ Christopher Anna, 2/18/2016
 class CuffLinkDatabase ():
     """ An object representing the data in a CuffLink output file"""
 
-    def __init__ (self, file):
+    COLUMNS = ['gene', 'log2(fold_change)']
+    """The columns WormBait actually reads from the CuffLink file. The rest are not kept"""
+
+    def __init__ (self, file, columns=None):
         """Constructs a CuffLinkDatabase object.
 
         The constructor reads a CSV file containing the results of a CuffLinks
-        run. The csv library is used to quickly and efficiently turn these
-        results into a dicionary. It is extremely important that headers
-        are the first row of this file!
+        run. The csv library is used to quickly and efficiently read these
+        results. It is extremely important that headers are the first row of
+        this file!
+
+        CuffLink files can run to hundreds of thousands of rows, but only a couple
+        of their columns are ever used. So instead of keeping a whole dictionary
+        per row, only the ID column (the first one) and the wanted columns are
+        kept, as one tuple per row. get() builds the dictionary on demand.
 
         Arguments:
         file -- the CSV file from which to read data
+        columns -- the names of the columns to keep. Defaults to COLUMNS. Columns that
+        are not in the file are ignored
         """
         
         self.CSVFile = file
-        self.data = {}
+        self.rows = {}
 
         reader = csv.reader(self.CSVFile, delimiter = ',', quotechar='"')
 
         headers = next(reader)
+        wanted = columns or self.COLUMNS
+        positions = [0] + [i for i, h in enumerate(headers) if i > 0 and h in wanted]
+        self.headers = tuple(headers[i] for i in positions)
         
         for row in reader:
-            self.data[row[0]] = dict(list(zip(headers,row)))
+            self.rows[row[0]] = tuple(row[i] for i in positions)
+
+    def get (self, dbId):
+        """Returns all the kept data corresponding to a single row in the CuffLink DB file. Returns a dict of this information"""
+        if dbId in self.rows:
+            return dict(zip(self.headers, self.rows[dbId]))
+        else:
+            return None
+
+    def getAll (self):
+        """Returns ALL the kept data stored in the CuffLink DB file, as a dict of dicts keyed by DB ID. Use with caution!"""
+        return dict((dbId, dict(zip(self.headers, row))) for dbId, row in self.rows.items())
+
+    def close (self):
+        """Does nothing. Present so that any database returned by openDatabase() can be closed the same way"""
+        pass
+
+
+class IndexedCuffLinkDatabase ():
+    """A CuffLink output file that is read one row at a time, as rows are asked for
+
+    The first time a file is opened, it is scanned once to build an index from
+    each DB ID to the position of its row in the file. The index is saved next
+    to the file (with the extension INDEX_SUFFIX) and reused for as long as the
+    file doesn't change, so later runs never scan the file at all. Rows are read
+    through a memory-mapped view of the file, and only when get() asks for them.
+
+    Every row is assumed to be on a single line.
+    """
+
+    INDEX_SUFFIX = '.wbidx'
+    """Appended to the database file's path to name its index"""
+
+    SIGNATURE_BYTES = 65536
+    """How much of the start and end of the file is hashed to tell whether it has changed"""
+
+    def __init__ (self, path):
+        """Opens the database file at `path`, building or reusing its index
+
+        If the index can't be written next to the file (e.g. a read-only share, or
+        a stale index owned by someone else), it is built in memory for this run only.
+
+        Arguments:
+        path -- the path to the CuffLink CSV file
+        """
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        firstLine = self.map.readline()
+        self.headers = next(csv.reader([firstLine.decode()], delimiter = ',', quotechar='"'))
+
+        signature = self.signature()
+        try:
+            self.index = sqlite3.connect(path + self.INDEX_SUFFIX, check_same_thread=False)
+            current = self.readSignature()
+        except sqlite3.Error:
+            self.index = sqlite3.connect(':memory:', check_same_thread=False)
+            current = None
+
+        if current != signature:
+            try:
+                self.build(len(firstLine), signature)
+            except sqlite3.Error:
+                # A stale index we can read but not replace (say, one built by another
+                # user on a shared install) is no use, so this run gets its own in memory
+                self.index.close()
+                self.index = sqlite3.connect(':memory:', check_same_thread=False)
+                self.build(len(firstLine), signature)
+
+        self.lock = threading.Lock()
+
+    def signature (self):
+        """Identifies the current contents of the file by its size, modification time and a hash of its ends"""
+        stat = os.stat(self.path)
+        digest = hashlib.sha1()
+        digest.update(self.map[:self.SIGNATURE_BYTES])
+        digest.update(self.map[-self.SIGNATURE_BYTES:])
+        return '%d:%d:%s' % (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+
+    def readSignature (self):
+        """Returns the signature stored in the index, or None if there isn't one"""
+        try:
+            row = self.index.execute("SELECT value FROM meta WHERE key='signature'").fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row and row[0]
+
+    def build (self, offset, signature):
+        """Scans the file once, recording the offset of every row, and saves the index
+
+        Arguments:
+        offset -- the position of the first row after the headers
+        signature -- the signature to store with the index
+        """
+        # The index can always be rebuilt from the file, so it doesn't need
+        # to survive a crash mid-write
+        self.index.execute('PRAGMA synchronous=OFF')
+        self.index.execute('DROP TABLE IF EXISTS meta')
+        self.index.execute('DROP TABLE IF EXISTS rows')
+        self.index.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.index.execute('CREATE TABLE rows (id TEXT PRIMARY KEY, offset INTEGER)')
+
+        def offsets ():
+            position = offset
+            self.map.seek(offset)
+            for line in iter(self.map.readline, b''):
+                # Only the first field is needed. Quoted fields are rare enough
+                # that they can go through the csv module
+                if line.startswith(b'"'):
+                    dbId = next(csv.reader([line.decode()], delimiter = ',', quotechar='"'))[0]
+                else:
+                    dbId = line.split(b',', 1)[0].decode()
+                yield (dbId, position)
+                position += len(line)
+
+        self.index.executemany('INSERT OR REPLACE INTO rows VALUES (?, ?)', offsets())
+        self.index.execute("INSERT INTO meta VALUES ('signature', ?)", (signature,))
+        self.index.commit()
+
+    def readRow (self, offset):
+        """Reads and parses the row starting at `offset`"""
+        end = self.map.find(b'\n', offset)
+        if end == -1:
+            end = len(self.map)
+        line = self.map[offset:end].decode().rstrip('\r')
+        return next(csv.reader([line], delimiter = ',', quotechar='"'))
 
     def get (self, dbId):
         """Returns all the data corresponding to a single row in the CuffLink DB file. Returns a dict of this information"""
-        if dbId in self.data:
-            return self.data[dbId]
+        with self.lock:
+            found = self.index.execute('SELECT offset FROM rows WHERE id=?', (dbId,)).fetchone()
+        if found:
+            return dict(zip(self.headers, self.readRow(found[0])))
         else:
             return None
 
     def getAll (self):
-        """Returns ALL the data stored in the CuffLink DB file. Use with caution!"""
-        return self.data
+        """Returns ALL the data stored in the CuffLink DB file. This reads the entire file. Use with caution!"""
+        with self.lock:
+            found = self.index.execute('SELECT id, offset FROM rows').fetchall()
+        return dict((dbId, dict(zip(self.headers, self.readRow(offset)))) for dbId, offset in found)
+
+    def close (self):
+        """Closes the file and its index"""
+        self.index.close()
+        self.map.close()
+        self.file.close()
+
+
+INDEX_THRESHOLD = 16 * 1024 * 1024
+"""Database files at least this large (in bytes) are opened as an IndexedCuffLinkDatabase"""
+
+def openDatabase (path):
+    """Opens the CuffLink database at `path` in whichever way suits its size
+
+    Small files are simply read into a CuffLinkDatabase. Large ones are opened as
+    an IndexedCuffLinkDatabase, so only the rows that are actually used are read.
+    """
+    if os.path.getsize(path) >= INDEX_THRESHOLD:
+        return IndexedCuffLinkDatabase(path)
+
+    with open(path, 'r') as csvDatabaseFile:
+        return CuffLinkDatabase(csvDatabaseFile)
+
+
+def openOutput (path, headers, staged=False):
+    """Creates the output for a run at `path`: a WormDB.OutputSQLite if the path has a SQLite suffix, else an OutputCSV
+
+    Pass `staged` as True when the file at `path` is also being read, as the
+    previous output of an incremental run. See OutputCSV.__init__
+    """
+    import WormDB
+    if WormDB.isSQLitePath(path):
+        return WormDB.OutputSQLite(path, headers, staged)
+    return OutputCSV(path, headers, staged)
+
+def openPreviousOutput (path, maxAge=None, fields=None):
+    """Reads the output of an earlier run at `path`, as a WormDB.PreviousOutputSQLite or a PreviousOutputCSV. See openOutput"""
+    import WormDB
+    if WormDB.isSQLitePath(path):
+        return WormDB.PreviousOutputSQLite(path, maxAge, fields)
+    return PreviousOutputCSV(path, maxAge, fields)
 
 
 class OutputCSV ():
@@ -56,8 +247,19 @@ class OutputCSV ():
     This object will perform the writing of data collected during
     the run of WormBait.
 
+    Genes with requests that failed for good are listed in a sidecar file
+    (the output path plus FAILURES_SUFFIX), one line per failed request, so
+    that an incremental run knows their blank fields aren't real and fetches
+    them again. The sidecar only exists while the output has such genes.
     """
-    def __init__ (self, path, headers):
+
+    FAILURES_SUFFIX = '.failures'
+    """Appended to the output path to name the file listing the genes with failed requests"""
+
+    STAGING_SUFFIX = '.partial'
+    """Appended to the output path to name the file a staged output is written to until it is finished"""
+
+    def __init__ (self, path, headers, staged=False):
         """Constructs an output CSV file.
 
         This constructor builds the object representing a CSV output. It
@@ -66,10 +268,19 @@ class OutputCSV ():
 
         Arguments
         path -- the desired filepath for the output
-        headers -- the title of each column. Not strictly necessary but makes output more accessible
+        headers -- the title of each column. Not strictly necessary but makes output more accessible.
+        Only these columns are written; any other data a WormData holds is left out
+        staged -- True to write to path + STAGING_SUFFIX instead, and only replace the file at `path`
+        once finish() is told the run is complete. An incremental run reads the output it is
+        replacing, so it mustn't lose that output if it is stopped short
         """
+        self.target = path
         self.path = path
+        if staged and path != '-':
+            self.path = path + self.STAGING_SUFFIX
         self.headers = headers
+        self.failuresFile = None
+        self.failuresWriter = None
 
     def write (self, listOfWormDatas):
         """Writes all the data in argument `listOfWormDatas` to the file"""
@@ -79,29 +290,195 @@ class OutputCSV ():
             if exclusivelyWBIds and w.describe() and 'db_id' in w.describe() and w.describe()['db_id'].startswith('XLOC'):
                 exclusivelyWBIds = False
 
-        if exclusivelyWBIds:
+        self.start(not exclusivelyWBIds)
+        try:
+            for wormData in listOfWormDatas:
+                self.writeRow(wormData)
+        finally:
+            self.finish()
+
+    def start (self, includeDbColumns=True):
+        """Creates the file and writes the header row
+
+        Use start(), writeRow() and finish() to write rows one at a time as they
+        become available, instead of handing a whole list to write(). Since the
+        columns are written before any rows, the caller must say up front whether
+        the 'db_id' and 'up/down' columns are wanted.
+
+        Arguments:
+        includeDbColumns -- False if no row will have a DB ID, in which case the
+        'db_id' and 'up/down' columns are left out
+        """
+        if not includeDbColumns:
             self.headers.remove('db_id')
             self.headers.remove('up/down')
 
         # This method requires a little kludgy glue to work on both Python2
         # and Python3. On v2, the file should be opened in binary write mode
         # On v3, this will cause exceptions. Unfortunately the 2to3 program
-        # doesn't pick up on this, so I make the fix here
-        if sys.version_info >= (3,0,0):
-           with open(self.path, 'w') as file:
-                writer = csv.DictWriter(file, fieldnames=self.headers)
-                writer.writeheader()
-                for wormData in listOfWormDatas:
-                    writer.writerow(wormData.describe())
+        # doesn't pick up on this, so I make the fix here. A path of '-' means
+        # standard output, so the CSV can be piped into another program
+        if self.path == '-':
+            self.file = sys.stdout
+        elif sys.version_info >= (3,0,0):
+            self.file = open(self.path, 'w')
         else:
-            with open(self.path, 'wb') as file:
-                writer = csv.DictWriter(file, fieldnames=self.headers)
-                writer.writeheader()
-                for wormData in listOfWormDatas:
-                    writer.writerow(wormData.describe())
+            self.file = open(self.path, 'wb')
+
+        # Rows restored from a journal or an earlier output may carry fields that
+        # this run didn't ask for, so anything outside the headers is dropped
+        self.writer = csv.DictWriter(self.file, fieldnames=self.headers, extrasaction='ignore')
+        self.writer.writeheader()
+        self.file.flush()
+
+        # The failures of an earlier output no longer apply to this one
+        if self.path != '-' and os.path.exists(self.path + self.FAILURES_SUFFIX):
+            os.remove(self.path + self.FAILURES_SUFFIX)
+
+    def writeRow (self, wormData):
+        """Appends the data of a single WormData to the file
+
+        The row is flushed straight away, so everything written so far survives
+        even if the run dies before finish() is called.
+        """
+        self.writer.writerow(wormData.describe())
+        self.file.flush()
+        if wormData.failures:
+            self.writeFailures(wormData)
+
+    def writeFailures (self, wormData):
+        """Lists the failed requests of a WormData in the failures sidecar, creating it if need be"""
+        if self.path == '-':
+            return
+
+        if self.failuresWriter is None:
+            self.failuresFile = open(self.path + self.FAILURES_SUFFIX, 'w')
+            self.failuresWriter = csv.writer(self.failuresFile)
+            self.failuresWriter.writerow(['db_id', 'gene_id', 'id', 'endpoint', 'reason'])
+
+        for failure in wormData.failures:
+            self.failuresWriter.writerow([wormData.dbId or '', wormData.geneID, failure['id'], failure['endpoint'],
+                                          failure['reason']])
+        self.failuresFile.flush()
+
+    def finish (self, complete=True):
+        """Closes the file (standard output is only flushed)
+
+        Arguments:
+        complete -- False if the run stopped short. A staged output is then thrown
+        away, leaving the file it would have replaced as it was
+        """
+        if self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+        if self.failuresFile:
+            self.failuresFile.close()
+
+        if self.path == self.target:
+            return
+        stagedFailures = self.path + self.FAILURES_SUFFIX
+        if not complete:
+            os.remove(self.path)
+            if os.path.exists(stagedFailures):
+                os.remove(stagedFailures)
+            return
+
+        os.replace(self.path, self.target)
+        if os.path.exists(stagedFailures):
+            os.replace(stagedFailures, self.target + self.FAILURES_SUFFIX)
+        elif os.path.exists(self.target + self.FAILURES_SUFFIX):
+            os.remove(self.target + self.FAILURES_SUFFIX)
         
             
 
+class PreviousOutputCSV ():
+    """The rows of an output CSV written by an earlier WormBait run
+
+    Used to re-run a list of IDs incrementally: genes that already have a row
+    in the previous output are taken from it instead of WormBase. Rows are
+    considered as old as the file itself. If the file is older than the allowed
+    age, or lacks a column this run needs, none of its rows are used. Nor are
+    the rows of genes whose requests failed (see OutputCSV.FAILURES_SUFFIX):
+    their blank fields may not be blank on WormBase, so they are fetched again.
+    """
+
+    def __init__ (self, path, maxAge=None, fields=None):
+        """Reads the previous output at `path`. A missing file simply has no rows
+
+        Arguments:
+        path -- the output CSV of the earlier run
+        maxAge -- the oldest (in seconds) the file may be for its rows to be used. None for no limit
+        fields -- the WormData fields this run collects. If the file was written with
+        fewer, its rows are not used. Defaults to WormData.FIELDS
+        """
+        self.path = path
+        self.rows = {}
+        self.lists = {}
+        self.used = False
+        self.mtime = None
+
+        if not os.path.exists(path):
+            return
+
+        self.mtime = os.path.getmtime(path)
+        if maxAge is not None and time.time() - self.mtime > maxAge:
+            return
+
+        self.load(path, fields or WormData.FIELDS)
+        for key in self.failedGenes(path):
+            self.rows.pop(key, None)
+
+    def load (self, path, fields):
+        """Reads the rows of the file into self.rows, unless it lacks a column for one of `fields`
+
+        A CSV only has the joined values of each list, so self.lists is left empty.
+        """
+        with open(path, 'r') as f:
+            reader = csv.DictReader(f)
+            for field in fields:
+                if field not in (reader.fieldnames or []):
+                    return
+
+            for row in reader:
+                # Empty cells were missing (or None) in the WormData that was written,
+                # so they are left out to reproduce the same row
+                data = dict((k, v) for k, v in row.items() if v)
+                self.rows[(data.get('db_id'), data.get('gene_id'))] = data
+
+    def failedGenes (self, path):
+        """Returns the set of (dbId, geneID) genes that had failed requests in the output at `path`"""
+        failed = set()
+        if not os.path.exists(path + OutputCSV.FAILURES_SUFFIX):
+            return failed
+
+        with open(path + OutputCSV.FAILURES_SUFFIX, 'r') as f:
+            for row in csv.DictReader(f):
+                failed.add((row['db_id'] or None, row['gene_id']))
+        return failed
+
+    def get (self, dbId, geneID):
+        """Returns the data of the previous row for this gene, or None if there isn't one"""
+        data = self.rows.get((dbId, geneID))
+        if data is not None:
+            self.used = True
+            return dict(data)
+        return None
+
+    def getLists (self, dbId, geneID):
+        """Returns the separate values of each list field of the previous row for this gene, where known. See WormData.lists"""
+        return dict(self.lists.get((dbId, geneID), {}))
+
+    def keepAge (self, path):
+        """Backdates the newly written output at `path` to the age of the previous output, if any of its rows were used
+
+        This way the merged file is never considered fresher than the oldest data
+        in it, and rows that were carried over still expire on time.
+        """
+        if self.used:
+            os.utime(path, (self.mtime, self.mtime))
+
+
 class WormData ():
     """An object representing a gene and its associated properties.
 
@@ -119,13 +496,51 @@ class WormData ():
     
     PROTEIN_BASE= "http://api.wormbase.org/rest/field/protein"
     """The API base URL for protein information"""
+
+    WIDGET_BASE = "http://api.wormbase.org/rest/widget/gene"
+    """The API base URL for gene widgets, each of which bundles several gene fields into one response"""
+
+    GENE_FIELDS = ['sequence_name', 'concise_description', 'gene_models', 'gene_class',
+                   'human_orthologs', 'nematode_orthologs', 'other_orthologs']
+    """The gene endpoints a WormData can request"""
+
+    FIELDS = ['sequence_name', 'protein_id', 'best_human_ortholog', 'description', 'gene_class',
+              'human_orthologs', 'nematode_orthologs', 'other_orthologs']
+    """The fields a WormData can collect from WormBase, named as they appear in the output"""
+
+    FIELD_ENDPOINTS = {'sequence_name': ['sequence_name'],
+                       'protein_id': ['gene_models'],
+                       'best_human_ortholog': ['gene_models'],
+                       'description': ['concise_description'],
+                       'gene_class': ['gene_class'],
+                       'human_orthologs': ['human_orthologs'],
+                       'nematode_orthologs': ['nematode_orthologs'],
+                       'other_orthologs': ['other_orthologs']}
+    """The gene endpoints each field is extracted from. best_human_ortholog also needs one
+    protein call per protein ID, which makes it by far the most expensive field"""
+
+    WIDGETS = {'overview': ['sequence_name', 'concise_description', 'gene_class'],
+               'homology': ['human_orthologs', 'nematode_orthologs', 'other_orthologs']}
+    """The gene widgets that hold more than one of GENE_FIELDS, and the fields each one holds"""
+
+    STRATEGIES = ['fields', 'widgets']
+    """How gene endpoints are requested. 'fields' makes one call per gene endpoint. 'widgets' makes
+    one call per widget instead wherever a widget covers several of the endpoints needed"""
+
+    DEFAULT_STRATEGY = 'widgets'
+    """The strategy used when none is given"""
+
+    MAX_FETCH_WORKERS = 8
+    """The most API calls a single WormData will have in flight at once"""
     
-    def __init__ (self, dbId, geneID, database):
+    def __init__ (self, dbId, geneID, database, autoPopulate=True, transport=None, cache=None, coalescer=None,
+                  fields=None, strategy=None, lazy=False, stats=None, executor=None):
         """Constructs a WormData object and kicks off the populate() method
 
         populate() can take up to a few seconds, since it involves making multiple
         calls to the WormBase API. Be careful about instantiating too many of these,
-        at once.
+        at once. A lazy WormData is cheap to create instead: nothing is fetched until
+        a field is asked for with get(), or a batch of them with prefetch().
 
         Arguments:
         xlocID -- the DB_ID parameter that corresponds to this item in the CuffLink database. This is only
@@ -137,13 +552,63 @@ class WormData ():
         database -- the CuffLinkDatabase object that holds the information generated by CuffLink. Used
         only for its exclusive information, like 'log2(fold_change)' 
 
+        autoPopulate -- if False, populate() is not called. The caller is then responsible for
+        populating the object, e.g. with populateAsync()
+
+        transport -- the WormNet.Transport used for every blocking API call. All WormData objects
+        in a run should share one. Defaults to WormNet.defaultTransport()
+
+        cache -- an optional WormCache.ResponseCache. When given, the network is only used for
+        responses that aren't already in the cache
+
+        coalescer -- an optional WormNet.Coalescer shared by the run. When given, a request that
+        another WormData has already made (or is making) is not made again
+
+        fields -- the names (from FIELDS) of the fields to collect. Endpoints that none of them
+        need are never requested. Defaults to every field
+
+        strategy -- one of STRATEGIES. Defaults to DEFAULT_STRATEGY
+
+        lazy -- if True, populate() is not called (whatever autoPopulate says), and get()
+        fetches each field the first time it is asked for. Any field in FIELDS may be
+        asked for, not just those in `fields`
+
+        stats -- an optional WormRun.RunStats, which every request is reported to
+
+        executor -- an optional concurrent.futures.Executor shared by the run, which the calls of
+        prefetch() are made on. Without one, each prefetch() starts (and stops) a thread pool of
+        its own, at most MAX_FETCH_WORKERS threads
+
         """
         self.geneID = geneID
         self.data = {}
+        self.lists = {}
         self.dbId = dbId
         self.data['gene_id'] = geneID
         self.database = database
-        self.populate()
+        self.transport = transport or WormNet.defaultTransport()
+        self.cache = cache
+        self.coalescer = coalescer
+        self.stats = stats
+        self.executor = executor
+        self.failures = []
+
+        self.fields = list(fields or self.FIELDS)
+        self.checkFields(self.fields)
+
+        self.strategy = strategy or self.DEFAULT_STRATEGY
+        if self.strategy not in self.STRATEGIES:
+            raise ValueError('Unknown strategy: ' + str(self.strategy))
+
+        # The fields collected so far, and the raw result of every gene endpoint
+        # fetched so far, so that no endpoint is requested twice
+        self.lazy = lazy
+        self.collected = set()
+        self.geneResults = {}
+        self.lock = threading.Lock()
+
+        if autoPopulate and not lazy:
+            self.populate()
 
     def populate (self):
         """Populates the WormData object with all the desired data from WormBase
@@ -169,104 +634,256 @@ class WormData ():
         CUFFLINK DEG FILE
         log2(fold_change)
 
+        None of the gene endpoints depend on each other, so they are all requested
+        at once through a thread pool: the run's shared one, or a small one of this
+        WormData's own (at most MAX_FETCH_WORKERS calls in flight). The protein calls depend only on gene_models, so they are sent as
+        soon as that one call returns, while the other gene calls are still running.
+
+        Only the endpoints needed for self.fields are requested (see geneEndpoints()),
+        and the protein calls are skipped altogether unless best_human_ortholog is
+        wanted. With the 'widgets' strategy, endpoints that share a widget are
+        collected with a single widget call (see requestPlan()).
+
         For more information on the WormBase API, visit the following page:
         http://www.wormbase.org/about/userguide/for_developers/API-REST#10--10
         """
 
         # All WormBase genes begin with the prefix 'WBGene'. If this prefix isn't present,
         # we don't even try to collect the data
-        if self.geneID and self.geneID.startswith("WBGene"):
-
-            # Get the log2(fold_change) value for this DB_ID, straight from the
-            # CuffLink database. This is the only value collected this way. Only collect
-            # this value if an DB_ID has been provided.
-            if self.dbId:
-                self.data['up/down'] = self.database.get(self.dbId)['log2(fold_change)']
-
-            # Most API calls will look like this. We call self.fetch and provide
-            # the base URL, unique ID, and endpoint. We get the results back in
-            # a JSON object and extract what we need from it
-            sequence = self.fetch(self.GENE_BASE, self.geneID, 'sequence_name')
-            self.data['sequence_name'] = sequence
-
-            description = self.fetch(self.GENE_BASE, self.geneID, 'concise_description')
-            self.data['description'] = description['text']
-
-            # The gene_models endpoint will return a JSON array of proteins. We
-            # must extract each protein ID and save it to the protein_id list
-            # in the self.data dictionary. These protein IDs will be used
-            # individually later on
-            geneModels = self.fetch(self.GENE_BASE, self.geneID, 'gene_models')
-            
-            self.data['protein_id'] = []
-            if geneModels and 'table' in geneModels:
-                for item in geneModels['table']:
-                    if item and 'protein' in item and 'id' in item['protein']:
-                        self.data['protein_id'].append(item['protein']['id'])
+        if self.isWormBaseGene():
+            self.collectFoldChange()
+            self.prefetch(self.fields)
 
+    async def populateAsync (self, fetcher):
+        """Coroutine version of populate(), for use with the asyncio backend
 
-            geneClass = self.fetch(self.GENE_BASE, self.geneID, 'gene_class')
-            if geneClass and 'tag' in geneClass and 'label' in geneClass['tag']:
-                self.data['gene_class'] = geneClass['tag']['label']
+        Collects exactly the same data as populate(), but every API call is made
+        through fetchAsync() on the given fetcher instead of a thread pool. The
+        protein calls are still sent as soon as gene_models returns.
 
-            humanOrthologs = self.fetch(self.GENE_BASE, self.geneID, 'human_orthologs')
-            self.data['human_orthologs'] = []
-            if humanOrthologs:
-                for item in humanOrthologs:
-                    self.data['human_orthologs'].append(item['ortholog']['label'])
+        Arguments:
+        fetcher -- an open WormNet.AsyncFetcher
+        """
+        if self.isWormBaseGene():
+            self.collectFoldChange()
+            await self.prefetchAsync(fetcher, self.fields)
 
-            # For data elements that can have multiple values, we concatenate the values
-            # together. The convenience method self.joinIfExtant is provided for this use
-            self.joinIfExtant('human_orthologs')
+    def isWormBaseGene (self):
+        """Identifies whether self.geneID looks like a WormBase gene ID, the only kind worth asking WormBase about"""
+        return bool(self.geneID) and self.geneID.startswith("WBGene")
 
-            nematodeOrthologs = self.fetch(self.GENE_BASE, self.geneID, 'nematode_orthologs')
-            self.data['nematode_orthologs'] = []
-            if nematodeOrthologs:
-                for item in nematodeOrthologs:
-                    self.data['nematode_orthologs'].append(item['ortholog']['label'])
+    def collectFoldChange (self):
+        """Reads the 'up/down' value for this DB ID from the CuffLink database, if there is a DB ID
 
-            self.joinIfExtant('nematode_orthologs')
+        This is the only value collected this way.
+        """
+        if self.dbId and 'up/down' not in self.data:
+            self.data['up/down'] = self.database.get(self.dbId)['log2(fold_change)']
 
-            otherOrthologs = self.fetch(self.GENE_BASE, self.geneID, 'other_orthologs')
-            self.data['other_orthologs'] = []
-            if otherOrthologs:
-                for item in otherOrthologs:
-                    self.data['other_orthologs'].append(item['ortholog']['label'])
+    def prefetch (self, fields):
+        """Collects several fields at once, skipping any that have already been collected
 
-            self.joinIfExtant('other_orthologs')
+        This does the work of populate(), for any list of fields. Lazy WormData
+        objects can use it to fetch a batch of fields together, which is much
+        quicker than letting get() fetch them one at a time. Gene endpoints
+        fetched earlier for other fields are not requested again.
 
-            self.data['best_human_ortholog'] = []
+        Arguments:
+        fields -- the names (from FIELDS) of the fields to collect
+        """
+        self.checkFields(fields)
+        if not self.isWormBaseGene():
+            return
+
+        with self.lock:
+            fields = [field for field in fields if field not in self.collected]
+            if not fields:
+                return
+
+            executor = self.executor or concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_FETCH_WORKERS)
+            try:
+                # Most API calls will look like this. We call self.fetch and provide
+                # the base URL, unique ID, and endpoint. Every gene endpoint is
+                # submitted up front; the results are collected further down
+                planFutures = []
+                for widget, datums in self.requestPlan(fields):
+                    planFutures.append((datums, executor.submit(self.fetchPlanned, widget, datums)))
+
+                # The protein fan-out has to wait for gene_models, but nothing else
+                proteinIDs = self.extractProteinIds(self.geneResults.get('gene_models'))
+                for datums, future in planFutures:
+                    if 'gene_models' in datums:
+                        proteinIDs = self.extractProteinIds(future.result()['gene_models'])
+                proteinFutures = []
+                if self.wantsProteins(fields):
+                    proteinFutures = [executor.submit(self.fetch, self.PROTEIN_BASE, proteinID, 'best_human_match')
+                                      for proteinID in proteinIDs]
+
+                for datums, future in planFutures:
+                    self.geneResults.update(future.result())
+                bestHumanMatches = [future.result() for future in proteinFutures]
+            finally:
+                if executor is not self.executor:
+                    executor.shutdown()
+
+            self.assemble(self.geneResults, proteinIDs, bestHumanMatches, fields)
+            self.collected.update(fields)
+
+    async def prefetchAsync (self, fetcher, fields):
+        """Coroutine version of prefetch()
+
+        Unlike prefetch(), this is not guarded against being run twice at once for
+        the same WormData.
 
-            # We need to proceed differently depending on whether we have 1 protein_id
-            # or many. We want to perform a request to the API for each protein_id, but
-            # if we have only 1, the value self.data['protein_id'] will be a string (str)
-            # and the traditional loop structure
-            #
-            #     for x in self.data['protein_id']
-            #         ...
-            #
-            # will result in a loop that repeats for each character in the string self.data['protein_id']
-            # So if the protein_id data is a single str, we proceed one way. If it's not, that means
-            # it must be a list, and we proceed another.
-            isSingular = isinstance(self.data['protein_id'], str)
-
-            # best_human_ortholog takes no small amount of effort to extract. For
-            # each protein_id collected earlier, we access that protein's endpoint
-            # in the WormBase API. The information we're looking for, the description
-            # of the best human ortholog is buried in several layers of JSON strata,
-            # making this section hard to read at best.
-            if self.data['protein_id'] and not isSingular:
-                for proteinID in self.data['protein_id']:
-                    bestHumanMatch = self.fetch(self.PROTEIN_BASE, proteinID, 'best_human_match')
-                    if bestHumanMatch and 'description' in bestHumanMatch:
-                        self.data['best_human_ortholog'].append(bestHumanMatch['description'])
-            elif self.data['protein_id']:
-                bestHumanMatch = self.fetch(self.PROTEIN_BASE, self.data['protein_id'], 'best_human_match')
-                if bestHumanMatch and 'description' in bestHumanMatch:
-                    self.data['best_human_ortholog'].append(bestHumanMatch['description'])
+        Arguments:
+        fetcher -- an open WormNet.AsyncFetcher
+        fields -- the names (from FIELDS) of the fields to collect
+        """
+        import asyncio
+        self.checkFields(fields)
+        fields = [field for field in fields if field not in self.collected]
+        if not fields or not self.isWormBaseGene():
+            return
+
+        planTasks = []
+        for widget, datums in self.requestPlan(fields):
+            planTasks.append((datums, asyncio.ensure_future(self.fetchPlannedAsync(fetcher, widget, datums))))
+
+        proteinIDs = self.extractProteinIds(self.geneResults.get('gene_models'))
+        for datums, task in planTasks:
+            if 'gene_models' in datums:
+                proteinIDs = self.extractProteinIds((await task)['gene_models'])
+        bestHumanMatches = []
+        if self.wantsProteins(fields):
+            bestHumanMatches = await asyncio.gather(*[self.fetchAsync(fetcher, self.PROTEIN_BASE, proteinID, 'best_human_match')
+                                                      for proteinID in proteinIDs])
+
+        for result in await asyncio.gather(*[task for datums, task in planTasks]):
+            self.geneResults.update(result)
+
+        self.assemble(self.geneResults, proteinIDs, bestHumanMatches, fields)
+        self.collected.update(fields)
+
+    def checkFields (self, fields):
+        """Raises ValueError if any of `fields` is not one of FIELDS"""
+        for field in fields:
+            if field not in self.FIELD_ENDPOINTS:
+                raise ValueError('Unknown field: ' + str(field))
+
+    def geneEndpoints (self, fields=None):
+        """Returns the gene endpoints needed for `fields` (default self.fields), in the order of GENE_FIELDS"""
+        needed = set()
+        for field in fields or self.fields:
+            needed.update(self.FIELD_ENDPOINTS[field])
+        return [datum for datum in self.GENE_FIELDS if datum in needed]
+
+    def requestPlan (self, fields=None):
+        """Works out the calls needed to collect the gene endpoints of `fields` (default self.fields)
+
+        With the 'fields' strategy every endpoint is a call of its own. With
+        'widgets', a widget is requested in place of its endpoints whenever it
+        covers at least two of the endpoints needed; a widget is a much larger
+        response than one field, so it isn't worth it for a single endpoint.
+        Endpoints already fetched for this WormData are left out.
+
+        Return:
+        a list of (widget, datums) pairs, one per call. widget is None for a plain
+        field call, in which case datums holds just that one endpoint
+        """
+        needed = [datum for datum in self.geneEndpoints(fields) if datum not in self.geneResults]
+        plan = []
+        if self.strategy == 'widgets':
+            for widget, widgetFields in sorted(self.WIDGETS.items()):
+                covered = [datum for datum in needed if datum in widgetFields]
+                if len(covered) >= 2:
+                    plan.append((widget, covered))
+                    needed = [datum for datum in needed if datum not in covered]
+
+        plan.extend((None, [datum]) for datum in needed)
+        return plan
+
+    def wantsProteins (self, fields=None):
+        """Identifies whether the per-protein best_human_match calls are needed for `fields` (default self.fields)"""
+        return 'best_human_ortholog' in (fields or self.fields)
+
+    def extractProteinIds (self, geneModels):
+        """Pulls the protein IDs out of the result of the gene_models endpoint
 
+        The gene_models endpoint will return a JSON array of proteins. We
+        must extract each protein ID so that it can be looked up individually
+        on the protein endpoint later on
 
+        Arguments:
+        geneModels -- the 'data' portion of the gene_models response, as returned by fetch()
+
+        Return:
+        a list of protein IDs, in the order WormBase lists them
+        """
+        proteinIDs = []
+        if geneModels and 'table' in geneModels:
+            for item in geneModels['table']:
+                if item and 'protein' in item and 'id' in item['protein']:
+                    proteinIDs.append(item['protein']['id'])
+        return proteinIDs
+
+    def assemble (self, geneResults, proteinIDs, bestHumanMatches, fields=None):
+        """Fills self.data from the raw results of the WormBase API calls
+
+        This is where the JSON returned by each endpoint is boiled down to the
+        values that end up in the output. It does no I/O of its own, so it does
+        not matter how (or in what order) the results were collected.
+
+        Arguments:
+        geneResults -- dict mapping (at least) each endpoint returned by geneEndpoints(fields) to the
+        result of fetch() for that endpoint
+        proteinIDs -- the list returned by extractProteinIds()
+        bestHumanMatches -- the best_human_match results, one per entry in proteinIDs. Empty if
+        best_human_ortholog is not wanted
+        fields -- the fields to fill in. Defaults to self.fields
+        """
+        fields = fields or self.fields
+
+        if 'sequence_name' in fields:
+            self.data['sequence_name'] = geneResults['sequence_name']
+
+        # A failed request leaves its result as None; the field is simply left blank
+        if 'description' in fields:
+            description = geneResults['concise_description']
+            if description and 'text' in description:
+                self.data['description'] = description['text']
+
+        if 'protein_id' in fields:
+            self.data['protein_id'] = list(proteinIDs)
             self.joinIfExtant('protein_id')
+
+        if 'gene_class' in fields:
+            geneClass = geneResults['gene_class']
+            if geneClass and 'tag' in geneClass and 'label' in geneClass['tag']:
+                self.data['gene_class'] = geneClass['tag']['label']
+
+        # For data elements that can have multiple values, we concatenate the values
+        # together. The convenience method self.joinIfExtant is provided for this use
+        for datum in ['human_orthologs', 'nematode_orthologs', 'other_orthologs']:
+            if datum not in fields:
+                continue
+
+            self.data[datum] = []
+            if geneResults[datum]:
+                for item in geneResults[datum]:
+                    self.data[datum].append(item['ortholog']['label'])
+
+            self.joinIfExtant(datum)
+
+        # best_human_ortholog takes no small amount of effort to extract. For
+        # each protein_id collected earlier, we accessed that protein's endpoint
+        # in the WormBase API. The information we're looking for, the description
+        # of the best human ortholog, is buried in several layers of JSON strata
+        if self.wantsProteins(fields):
+            self.data['best_human_ortholog'] = []
+            for bestHumanMatch in bestHumanMatches:
+                if bestHumanMatch and 'description' in bestHumanMatch:
+                    self.data['best_human_ortholog'].append(bestHumanMatch['description'])
+
             self.joinIfExtant('best_human_ortholog')
 
     def joinIfExtant (self, datum):
@@ -280,10 +897,29 @@ class WormData ():
         a comma-separated string of all values in datum
         """
         
+        # The values themselves are kept too, for outputs that store them separately. See getList()
+        self.lists[datum] = list(self.data[datum])
         if len(self.data[datum]) == 0:
             self.data[datum] = None
         else:
             self.data[datum] = ', '.join(self.data[datum])
+
+    def getList (self, datum):
+        """Returns the separate values of a field that joinIfExtant() joined, e.g. 'human_orthologs'
+
+        A WormData restored from a journal or a previous output database gets its
+        lists back too. One restored from a previous output CSV only has the joined
+        string, so it is split again at each ', ', and a value that itself held
+        ', ' comes back in pieces.
+
+        Return:
+        a list of strings, empty if the field has no values
+        """
+        if datum in self.lists:
+            return list(self.lists[datum])
+        if self.data.get(datum):
+            return self.data[datum].split(', ')
+        return []
         
     def get (self, datum):
         """Public access to the data stored in self.data
@@ -292,39 +928,200 @@ class WormData ():
         datum -- the name of the desired data. E.g., 'sequence_name', 'human_orthologs'
 
         Return:
-        the data with the given name in self.data, if it exists. `None` if it doesn't
+        the data with the given name in self.data, if it exists. `None` if it doesn't. On a
+        lazy WormData, a field that hasn't been collected yet is fetched first
         """
+        if self.lazy:
+            if datum == 'up/down':
+                self.collectFoldChange()
+            elif datum in self.FIELD_ENDPOINTS:
+                self.prefetch([datum])
+
         if datum in self.data:
             return self.data[datum]
         else:
             return None
 
     def describe (self):
-        """Returns the entirety of self.data"""
+        """Returns the entirety of self.data. On a lazy WormData, only what has been collected so far"""
         return self.data
 
     def fetch (self, baseUrl, id, datum):
         """Makes an HTTP GET request to the WormBase RESTful API
 
+        If this WormData has a coalescer, the request is only made if no other
+        WormData in the run has made it already. Failed attempts are retried as
+        the transport's RetryPolicy allows. If the request still fails, the
+        failure is recorded in self.failures and None is returned.
+
         Arguments:
         baseUrl -- the base URL of the API. In this module, could be GENE_BASE or PROTEIN_BASE
         id -- the WormBase ID of the gene or protein for lookup
         datum -- the specific endpoint that will be accessed
         """
-        r = requests.get(baseUrl + '/' + id + '/' + datum, headers=self.headers)
+        try:
+            return self.fetchShared(baseUrl, id, datum)
+        except WormNet.FetchError as e:
+            self.recordFailure(id, datum, e)
+            return None
+
+    def fetchShared (self, baseUrl, id, datum):
+        """Does the work of fetch(), through the coalescer if there is one. Raises WormNet.FetchError if the request fails"""
+        if self.coalescer:
+            return self.coalescer.call((baseUrl, id, datum), self.fetchDirect, baseUrl, id, datum)
+        else:
+            return self.fetchDirect(baseUrl, id, datum)
+
+    def fetchPlanned (self, widget, datums):
+        """Makes one call of the plan from requestPlan()
 
-        # We must manipulate the data in JSON format. We try to get the JSON form
-        # of the response to the request. If it doesn't work, return None
+        Return:
+        a dict mapping each of `datums` to its result, as fetch() would have returned it
+        """
+        if widget is None:
+            return {datums[0]: self.fetch(self.GENE_BASE, self.geneID, datums[0])}
+
+        # Field-level calls are the fallback for a widget that fails, or that
+        # doesn't hold a field we expected it to. The widget's failure isn't
+        # recorded, since the fallback may well succeed
         try:
-            j = r.json()
-        except:
+            widgetFields = self.fetchShared(self.WIDGET_BASE, self.geneID, widget)
+        except WormNet.FetchError:
+            widgetFields = None
+
+        results = {}
+        for datum in datums:
+            if widgetFields and datum in widgetFields and isinstance(widgetFields[datum], dict):
+                results[datum] = widgetFields[datum].get('data')
+            else:
+                results[datum] = self.fetch(self.GENE_BASE, self.geneID, datum)
+        return results
+
+    def fetchDirect (self, baseUrl, id, datum):
+        """Does the work of fetch(), without any coalescing. Consults the cache, then the network
+
+        Raises WormNet.FetchError if the request fails. Every call is reported to
+        self.stats, if there is one.
+        """
+        start = time.time()
+        if self.cache:
+            j = self.cache.get(baseUrl, id, datum)
+            if j is not None:
+                return self.measure(baseUrl, datum, start, self.unwrap(j, datum), cached=True)
+
+        # We must manipulate the data in JSON format. The transport hands back the
+        # JSON form of the response, retrying if it doesn't get one
+        try:
+            j, size = self.transport.getJsonAndSize(baseUrl + '/' + id + '/' + datum, headers=self.headers)
+        except WormNet.FetchError:
+            self.measure(baseUrl, datum, start, None, error=True)
+            raise
+
+        # Only responses we could decode are cached, so a bad response is
+        # retried on the next run
+        if self.cache:
+            self.cache.put(baseUrl, id, datum, j)
+
+        return self.measure(baseUrl, datum, start, self.unwrap(j, datum), size)
+
+    async def fetchAsync (self, fetcher, baseUrl, id, datum):
+        """Coroutine version of fetch(). Makes the request through an asyncio fetcher
+
+        Arguments:
+        fetcher -- an open WormNet.AsyncFetcher
+        baseUrl -- the base URL of the API. In this module, could be GENE_BASE or PROTEIN_BASE
+        id -- the WormBase ID of the gene or protein for lookup
+        datum -- the specific endpoint that will be accessed
+        """
+        try:
+            return await self.fetchSharedAsync(fetcher, baseUrl, id, datum)
+        except WormNet.FetchError as e:
+            self.recordFailure(id, datum, e)
             return None
 
+    async def fetchSharedAsync (self, fetcher, baseUrl, id, datum):
+        """Coroutine version of fetchShared()"""
+        if self.coalescer:
+            return await self.coalescer.callAsync((baseUrl, id, datum), self.fetchDirectAsync, fetcher, baseUrl, id, datum)
+        else:
+            return await self.fetchDirectAsync(fetcher, baseUrl, id, datum)
+
+    async def fetchPlannedAsync (self, fetcher, widget, datums):
+        """Coroutine version of fetchPlanned(). Any fallback field calls are made at once"""
+        import asyncio
+        if widget is None:
+            return {datums[0]: await self.fetchAsync(fetcher, self.GENE_BASE, self.geneID, datums[0])}
+
+        try:
+            widgetFields = await self.fetchSharedAsync(fetcher, self.WIDGET_BASE, self.geneID, widget)
+        except WormNet.FetchError:
+            widgetFields = None
+
+        results = {}
+        missing = []
+        for datum in datums:
+            if widgetFields and datum in widgetFields and isinstance(widgetFields[datum], dict):
+                results[datum] = widgetFields[datum].get('data')
+            else:
+                missing.append(datum)
+
+        fallbacks = await asyncio.gather(*[self.fetchAsync(fetcher, self.GENE_BASE, self.geneID, datum) for datum in missing])
+        results.update(zip(missing, fallbacks))
+        return results
+
+    async def fetchDirectAsync (self, fetcher, baseUrl, id, datum):
+        """Coroutine version of fetchDirect()"""
+        start = time.time()
+        if self.cache:
+            j = self.cache.get(baseUrl, id, datum)
+            if j is not None:
+                return self.measure(baseUrl, datum, start, self.unwrap(j, datum), cached=True)
+
+        try:
+            j, size = await fetcher.getJsonAndSize(baseUrl + '/' + id + '/' + datum, headers=self.headers)
+        except WormNet.FetchError:
+            self.measure(baseUrl, datum, start, None, error=True)
+            raise
+
+        if self.cache:
+            self.cache.put(baseUrl, id, datum, j)
+
+        return self.measure(baseUrl, datum, start, self.unwrap(j, datum), size)
+
+    def measure (self, baseUrl, datum, start, value, size=0, cached=False, error=False):
+        """Reports a request that began at `start` to self.stats, if there is one. Returns `value` (the unwrapped data)
+
+        The endpoint is named after the kind of URL and the datum, e.g. 'gene/gene_models'
+        or 'widget/overview'. A value of None counts as an empty result, unless the
+        request failed.
+        """
+        if self.stats:
+            kind = {self.GENE_BASE: 'gene', self.PROTEIN_BASE: 'protein', self.WIDGET_BASE: 'widget'}.get(baseUrl, baseUrl)
+            self.stats.record(kind + '/' + datum, time.time() - start, size, error, value is None and not error, cached)
+        return value
+
+    def recordFailure (self, id, datum, error):
+        """Notes a request that could not be completed. The fields that depend on it are left blank"""
+        self.failures.append({'id': id, 'endpoint': datum, 'reason': error.reason})
+
+    def unwrap (self, j, datum):
+        """Extracts the useful part of a decoded WormBase response
+
+        Arguments:
+        j -- the decoded JSON object returned by the API
+        datum -- the endpoint that was accessed
+
+        Return:
+        the 'data' value for the endpoint, or None if it is not present. For a widget,
+        the whole 'fields' object, which holds one such value per field
+        """
         # WormBase provides a decent amount of ancillary data when returning from
         # its API. We are not interested in anything outside of the 'data' key
         # in the returned JSON object, so we extract it here. If there is no 'data'
-        # in the JSON object, return None
-        if datum in j and 'data' in j[datum]:
+        # in the JSON object, return None. Widgets wrap their fields differently
+        if datum in self.WIDGETS:
+            return j.get('fields')
+        elif datum in j and 'data' in j[datum]:
             return j[datum]['data']
         else:
             return None
@@ -0,0 +1,126 @@
+import sqlite3
+import threading
+import json
+import time
+
+"""The WormCache module holds the on-disk cache of WormBase API responses
+
+WormBait runs are often repeated on overlapping lists of genes, and WormBase
+answers the same question the same way from one day to the next. Responses are
+therefore kept in a small SQLite database, so that a repeated run only goes to
+the network for what it hasn't seen before.
+"""
+
+class ResponseCache ():
+    """A persistent cache of decoded WormBase API responses
+
+    Each entry is keyed by the base URL, the WormBase ID and the datum (endpoint)
+    that was requested, exactly as they are passed to WormData.fetch(). Entries
+    expire after a time-to-live, and once the cache grows past its size cap the
+    least recently used entries are evicted.
+
+    The cache can be used from many threads at once. All access goes through a
+    single SQLite connection guarded by a lock.
+    """
+
+    MODES = ['use', 'refresh', 'bypass']
+    """How the cache is used. 'use' reads and writes the cache. 'refresh' ignores what is in
+    the cache but stores fresh responses. 'bypass' neither reads nor writes it"""
+
+    DEFAULT_TTL = 30 * 24 * 60 * 60
+    """Seconds an entry is considered fresh (30 days)"""
+
+    DEFAULT_MAX_BYTES = 500 * 1024 * 1024
+    """The size the cache may grow to before entries are evicted (500 MB)"""
+
+    def __init__ (self, path, ttl=None, maxBytes=None, mode='use'):
+        """Opens (creating if necessary) the cache database at `path`
+
+        Arguments:
+        path -- the file that holds the cache
+        ttl -- seconds an entry stays fresh. Defaults to DEFAULT_TTL. 0 means nothing is ever fresh
+        maxBytes -- the most response data to keep. Defaults to DEFAULT_MAX_BYTES. 0 keeps nothing
+        mode -- one of MODES. Defaults to 'use'
+        """
+        if mode not in self.MODES:
+            raise ValueError('Unknown cache mode: ' + str(mode))
+
+        self.path = path
+        # Zero is a meaningful setting for either, so only None means the default
+        self.ttl = self.DEFAULT_TTL if ttl is None else ttl
+        self.maxBytes = self.DEFAULT_MAX_BYTES if maxBytes is None else maxBytes
+        self.mode = mode
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses ('
+                                'base TEXT, id TEXT, datum TEXT, body TEXT, size INTEGER, '
+                                'fetched REAL, accessed REAL, PRIMARY KEY (base, id, datum))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get (self, base, id, datum):
+        """Looks up a cached response
+
+        Return:
+        the decoded JSON response, or None on a miss (including expired entries, and
+        always when the mode is not 'use')
+        """
+        if self.mode != 'use':
+            return None
+
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT body, fetched FROM responses WHERE base=? AND id=? AND datum=?',
+                                          (base, id, datum)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                return None
+
+            self.connection.execute('UPDATE responses SET accessed=? WHERE base=? AND id=? AND datum=?',
+                                    (now, base, id, datum))
+        return json.loads(row[0])
+
+    def put (self, base, id, datum, j):
+        """Stores a decoded JSON response, evicting old entries if the cache is over its size cap"""
+        if self.mode == 'bypass':
+            return
+
+        body = json.dumps(j)
+        now = time.time()
+        with self.lock:
+            old = self.connection.execute('SELECT size FROM responses WHERE base=? AND id=? AND datum=?',
+                                          (base, id, datum)).fetchone()
+            if old:
+                self.size -= old[0]
+
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (base, id, datum, body, len(body), now, now))
+            self.size += len(body)
+
+            if self.size > self.maxBytes:
+                self.evict()
+
+    def evict (self):
+        """Removes least recently used entries until the cache is back under 90% of its cap. Call with the lock held"""
+        target = self.maxBytes * 0.9
+        rows = self.connection.execute('SELECT base, id, datum, size FROM responses ORDER BY accessed')
+        doomed = []
+        for base, id, datum, size in rows:
+            if self.size <= target:
+                break
+            doomed.append((base, id, datum))
+            self.size -= size
+
+        self.connection.executemany('DELETE FROM responses WHERE base=? AND id=? AND datum=?', doomed)
+
+    def clear (self):
+        """Empties the cache"""
+        with self.lock:
+            self.connection.execute('DELETE FROM responses')
+            self.size = 0
+
+    def close (self):
+        """Closes the cache database"""
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,282 @@
+import sqlite3
+import os
+import WormCSV
+
+"""The WormDB module holds the SQLite output of WormBait
+
+An output CSV is fine for a few thousand genes, but joining hundreds of
+thousands of rows against other tables means parsing the whole file every
+time, and the comma-joined ortholog lists can't be searched without splitting
+them apart again. OutputSQLite writes the same results into a SQLite database
+instead, with each list stored one value per row in a table of its own, and
+with the IDs indexed, so that a question like "which genes have human ortholog
+X?" is a single indexed query. An output path ending in one of SUFFIXES is
+written this way; see WormCSV.openOutput().
+"""
+
+SUFFIXES = ['.sqlite', '.sqlite3', '.db']
+"""Output paths ending in any of these are written as SQLite rather than CSV"""
+
+def isSQLitePath (path):
+    """Identifies whether the output at `path` is a SQLite database, going by its suffix"""
+    return os.path.splitext(path)[1].lower() in SUFFIXES
+
+
+class OutputSQLite ():
+    """An output database, written in place of an output CSV
+
+    The database holds these tables:
+
+    genes -- one row per output row, in output order: row, db_id, gene_id, up_down,
+    sequence_name, description and gene_class
+    proteins -- gene_row, position, protein_id
+    best_human_orthologs -- gene_row, position, description
+    orthologs -- gene_row, kind ('human', 'nematode' or 'other'), position, label
+    fields -- the name of each WormData field the run collected
+    failures -- gene_row, id, endpoint and reason of each request that failed for good
+
+    Every child table refers to genes.row, and position keeps each list in the
+    order WormBase gave it. genes.gene_id, genes.db_id, proteins.protein_id and
+    orthologs (kind, label) are indexed, as is gene_row in each child table. The
+    view 'output' puts everything back together with the same columns (and the
+    same comma-joined lists) as an output CSV.
+
+    Rows are inserted BATCH_SIZE at a time, each batch in one transaction. A run
+    that dies loses at most the batch in progress, and the run journal still
+    holds those genes.
+    """
+
+    STAGING_SUFFIX = WormCSV.OutputCSV.STAGING_SUFFIX
+    """Appended to the output path to name the database a staged output is written to until it is finished"""
+
+    SIDE_FILES = ['-journal', '-wal', '-shm']
+    """The files SQLite may keep next to a database, which belong to it and not to a replacement"""
+
+    BATCH_SIZE = 500
+    """How many rows are inserted per transaction"""
+
+    LIST_TABLES = {'protein_id': ('proteins', 'protein_id'),
+                   'best_human_ortholog': ('best_human_orthologs', 'description')}
+    """The multi-valued fields kept in a table of their own, as (table, column)"""
+
+    ORTHOLOG_KINDS = {'human_orthologs': 'human', 'nematode_orthologs': 'nematode', 'other_orthologs': 'other'}
+    """The ortholog fields, which share the orthologs table, and the kind each is stored as"""
+
+    SCHEMA = ['CREATE TABLE genes (row INTEGER PRIMARY KEY, db_id TEXT, gene_id TEXT, up_down REAL, '
+              'sequence_name TEXT, description TEXT, gene_class TEXT)',
+              'CREATE TABLE proteins (gene_row INTEGER REFERENCES genes (row), position INTEGER, protein_id TEXT)',
+              'CREATE TABLE best_human_orthologs (gene_row INTEGER REFERENCES genes (row), position INTEGER, '
+              'description TEXT)',
+              'CREATE TABLE orthologs (gene_row INTEGER REFERENCES genes (row), kind TEXT, position INTEGER, label TEXT)',
+              'CREATE TABLE fields (name TEXT PRIMARY KEY)',
+              'CREATE TABLE failures (gene_row INTEGER REFERENCES genes (row), id TEXT, endpoint TEXT, reason TEXT)',
+              'CREATE INDEX genes_gene_id ON genes (gene_id)',
+              'CREATE INDEX genes_db_id ON genes (db_id)',
+              'CREATE INDEX proteins_protein_id ON proteins (protein_id)',
+              'CREATE INDEX proteins_gene_row ON proteins (gene_row)',
+              'CREATE INDEX best_human_orthologs_gene_row ON best_human_orthologs (gene_row)',
+              'CREATE INDEX orthologs_label ON orthologs (kind, label)',
+              'CREATE INDEX orthologs_gene_row ON orthologs (gene_row)']
+    """The statements that create the tables and indexes. See also OUTPUT_VIEW"""
+
+    OUTPUT_VIEW = ('CREATE VIEW output AS SELECT g.db_id AS db_id, g.gene_id AS gene_id, g.up_down AS "up/down", '
+                   'g.sequence_name AS sequence_name, '
+                   '(SELECT group_concat(protein_id, \', \') FROM (SELECT protein_id FROM proteins p '
+                   'WHERE p.gene_row = g.row ORDER BY position)) AS protein_id, '
+                   '(SELECT group_concat(description, \', \') FROM (SELECT description FROM best_human_orthologs b '
+                   'WHERE b.gene_row = g.row ORDER BY position)) AS best_human_ortholog, '
+                   'g.description AS description, g.gene_class AS gene_class, %s '
+                   'FROM genes g ORDER BY g.row')
+    """The view that lays the tables out like an output CSV. The ortholog columns are filled in by start()"""
+
+    def __init__ (self, path, headers, staged=False):
+        """Constructs an output database. Nothing is written until start() is called
+
+        Arguments:
+        path -- the desired filepath for the output. Any file already there is replaced
+        headers -- the output columns, as for WormCSV.OutputCSV. Only these are filled in
+        staged -- True to build the database at path + STAGING_SUFFIX, as for WormCSV.OutputCSV
+        """
+        if path == '-':
+            raise ValueError('A SQLite output cannot be written to standard output')
+
+        self.target = path
+        self.path = path + self.STAGING_SUFFIX if staged else path
+        self.headers = list(headers)
+        self.connection = None
+        self.pending = []
+        self.rows = 0
+
+    def write (self, listOfWormDatas):
+        """Writes all the data in argument `listOfWormDatas` to the database"""
+        self.start()
+        try:
+            for wormData in listOfWormDatas:
+                self.writeRow(wormData)
+        finally:
+            self.finish()
+
+    def start (self, includeDbColumns=True):
+        """Creates the database, replacing any old one, and its tables
+
+        Arguments:
+        includeDbColumns -- accepted for compatibility with WormCSV.OutputCSV. The db_id and up_down
+        columns are always there, and simply left empty when there is no DB ID
+        """
+        self.removeDatabase(self.path)
+
+        # Transactions are begun and committed by hand, one per batch
+        self.connection = sqlite3.connect(self.path, isolation_level=None)
+        for statement in self.SCHEMA:
+            self.connection.execute(statement)
+
+        orthologColumns = []
+        for datum, kind in sorted(self.ORTHOLOG_KINDS.items()):
+            orthologColumns.append('(SELECT group_concat(label, \', \') FROM (SELECT label FROM orthologs o '
+                                   'WHERE o.gene_row = g.row AND o.kind = \'%s\' ORDER BY position)) AS %s' %
+                                   (kind, datum))
+        self.connection.execute(self.OUTPUT_VIEW % ', '.join(orthologColumns))
+
+        fields = [h for h in self.headers if h in WormCSV.WormData.FIELDS]
+        self.connection.executemany('INSERT INTO fields VALUES (?)', [(field,) for field in fields])
+
+    def writeRow (self, wormData):
+        """Queues the data of a single WormData, inserting the queue once it holds BATCH_SIZE rows"""
+        self.pending.append(wormData)
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush (self):
+        """Inserts every queued row in a single transaction"""
+        if not self.pending:
+            return
+
+        genes = []
+        children = dict((table, []) for table, column in self.LIST_TABLES.values())
+        orthologs = []
+        failures = []
+        for wormData in self.pending:
+            self.rows += 1
+            row = self.rows
+            data = wormData.describe()
+            genes.append((row, data.get('db_id'), data.get('gene_id'), self.cell(data, 'up/down'),
+                          self.cell(data, 'sequence_name'), self.cell(data, 'description'),
+                          self.cell(data, 'gene_class')))
+
+            for datum, (table, column) in self.LIST_TABLES.items():
+                if datum in self.headers:
+                    for position, value in enumerate(wormData.getList(datum)):
+                        children[table].append((row, position, value))
+
+            for datum, kind in self.ORTHOLOG_KINDS.items():
+                if datum in self.headers:
+                    for position, label in enumerate(wormData.getList(datum)):
+                        orthologs.append((row, kind, position, label))
+
+            for failure in wormData.failures:
+                failures.append((row, failure['id'], failure['endpoint'], failure['reason']))
+
+        self.connection.execute('BEGIN')
+        try:
+            self.connection.executemany('INSERT INTO genes VALUES (?, ?, ?, ?, ?, ?, ?)', genes)
+            for table, values in children.items():
+                self.connection.executemany('INSERT INTO %s VALUES (?, ?, ?)' % table, values)
+            self.connection.executemany('INSERT INTO orthologs VALUES (?, ?, ?, ?)', orthologs)
+            self.connection.executemany('INSERT INTO failures VALUES (?, ?, ?, ?)', failures)
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+        self.pending = []
+
+    def cell (self, data, column):
+        """Returns the value of `column` from a WormData's data, or None if the column isn't one of the headers"""
+        if column not in self.headers:
+            return None
+        return data.get(column)
+
+    def finish (self, complete=True):
+        """Inserts any rows still queued and closes the database
+
+        Arguments:
+        complete -- False if the run stopped short. A staged database is then thrown
+        away, leaving the one it would have replaced as it was
+        """
+        if self.connection is None:
+            return
+        try:
+            if complete or self.path == self.target:
+                self.flush()
+        finally:
+            self.connection.close()
+            self.connection = None
+
+        if self.path == self.target:
+            return
+        if not complete:
+            self.removeDatabase(self.path)
+            return
+
+        # A leftover journal next to the old database would be applied to the new one
+        self.removeDatabase(self.target)
+        os.replace(self.path, self.target)
+
+    def removeDatabase (self, path):
+        """Deletes the database at `path`, if there is one, along with its SIDE_FILES"""
+        for suffix in [''] + self.SIDE_FILES:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+class PreviousOutputSQLite (WormCSV.PreviousOutputCSV):
+    """The rows of an output database written by an earlier WormBait run. See WormCSV.PreviousOutputCSV"""
+
+    def load (self, path, fields):
+        """Reads the rows of the 'output' view, unless the database was written without one of `fields`
+
+        The separate values of each list are read back from the child tables into
+        self.lists, since a value may itself hold the ', ' the view joins them with.
+        """
+        connection = sqlite3.connect(path)
+        try:
+            written = set(name for (name,) in connection.execute('SELECT name FROM fields'))
+            for field in fields:
+                if field not in written:
+                    return
+
+            cursor = connection.execute('SELECT * FROM output')
+            columns = [description[0] for description in cursor.description]
+            for values in cursor:
+                # As with a CSV, empty cells are left out, and everything is a string
+                data = dict((k, str(v)) for k, v in zip(columns, values) if v is not None and v != '')
+                self.rows[(data.get('db_id'), data.get('gene_id'))] = data
+
+            queries = {}
+            for datum, (table, column) in OutputSQLite.LIST_TABLES.items():
+                queries[datum] = ('SELECT g.db_id, g.gene_id, c.%s FROM %s c JOIN genes g ON g.row = c.gene_row '
+                                  'ORDER BY c.gene_row, c.position' % (column, table), ())
+            for datum, kind in OutputSQLite.ORTHOLOG_KINDS.items():
+                queries[datum] = ('SELECT g.db_id, g.gene_id, o.label FROM orthologs o JOIN genes g ON g.row = o.gene_row '
+                                  'WHERE o.kind = ? ORDER BY o.gene_row, o.position', (kind,))
+            for datum, (query, parameters) in queries.items():
+                if datum not in written:
+                    continue
+                for dbId, geneID, value in connection.execute(query, parameters):
+                    self.lists.setdefault((dbId, geneID), {}).setdefault(datum, []).append(value)
+        except sqlite3.Error:
+            # Not a WormBait output database (or a damaged one), so there is nothing to reuse
+            self.rows = {}
+            self.lists = {}
+        finally:
+            connection.close()
+
+    def failedGenes (self, path):
+        """Returns the set of (dbId, geneID) genes that had failed requests, from the failures table"""
+        connection = sqlite3.connect(path)
+        try:
+            return set(connection.execute('SELECT DISTINCT g.db_id, g.gene_id FROM failures f '
+                                          'JOIN genes g ON g.row = f.gene_row'))
+        except sqlite3.Error:
+            return set()
+        finally:
+            connection.close()
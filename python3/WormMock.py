@@ -0,0 +1,276 @@
+import http.server
+import urllib.request
+import multiprocessing
+import threading
+import collections
+import random
+import json
+import time
+import WormCSV
+
+"""The WormMock module holds a local stand-in for the WormBase REST API
+
+WormBait's speed is almost entirely a matter of how it talks to WormBase, and
+the real API is far too slow and too variable to measure that against. The mock
+server here answers the same gene, protein and widget URLs that WormData uses,
+from made-up (or fixture) data, with as much latency and as many errors as it
+is told to. See wormbaitbench.py, which uses it to benchmark whole runs.
+"""
+
+class MockServer (http.server.ThreadingHTTPServer):
+    """The HTTP server behind MockWormBase. One thread per connection"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    request_queue_size = 256
+    """WormBait opens many connections at once; the default backlog of 5 would refuse some"""
+
+
+class MockHandler (http.server.BaseHTTPRequestHandler):
+    """Answers a single request to the MockServer by handing it to the MockWormBase"""
+
+    # Keep-alive, so the transport's connection pool is exercised like it is against WormBase
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET (self):
+        status, headers, body = self.server.mock.respond(self.path)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message (self, format, *args):
+        """Keeps the server quiet. A benchmark makes far too many requests to log"""
+        pass
+
+
+class MockWormBase ():
+    """A local server that imitates the parts of the WormBase REST API that WormBait uses
+
+    It serves /rest/field/gene/{id}/{datum}, /rest/field/protein/{id}/best_human_match
+    and /rest/widget/gene/{id}/{widget}. Every gene has the same data, with its
+    own ID filled in, so any list of WBGene IDs can be used. Each request can be
+    delayed, and a share of them can be answered with a 503 instead of data.
+
+    The server counts the requests it answers, per endpoint, and times how long
+    each one took to serve. See stats().
+
+    The server can run on a thread of this process (start()) or in a process of
+    its own (startProcess()). A benchmark should use the latter: in the same
+    process, the server competes with WormBait for the interpreter lock, and
+    WormBait looks slower than it is.
+    """
+
+    DEFAULT_FIXTURES = {'sequence_name': '{id}.1',
+                        'concise_description': {'text': 'Mock concise description of {id}'},
+                        'gene_class': {'tag': {'label': 'mck-1'}},
+                        'human_orthologs': [{'ortholog': {'label': 'MOCK1'}}, {'ortholog': {'label': 'MOCK2'}}],
+                        'nematode_orthologs': [{'ortholog': {'label': 'CBG{id}'}}],
+                        'other_orthologs': [{'ortholog': {'label': 'YMR{id}'}}],
+                        'best_human_match': {'description': 'Human match for {id}'}}
+    """The data served for each endpoint. '{id}' in any string is replaced by the gene or protein ID"""
+
+    DEFAULT_PROTEINS = 2
+    """How many proteins each gene's gene_models lists, unless the fixtures give gene_models"""
+
+    def __init__ (self, latency=0.0, jitter=0.0, errorRate=0.0, retryAfter=None, slowRate=0.0, slowLatency=None,
+                  fixtures=None, proteins=None, port=0):
+        """Constructs a MockWormBase. Call start() to begin serving
+
+        Arguments:
+        latency -- seconds every request is delayed by
+        jitter -- seconds. The delay varies uniformly by up to this much either side of `latency`
+        errorRate -- the share (0 to 1) of requests answered with a 503 instead of data
+        retryAfter -- if given, the seconds put in a Retry-After header on every 503
+        slowRate -- the share (0 to 1) of requests that are delayed by `slowLatency` instead
+        slowLatency -- seconds a slow request is delayed by. Defaults to ten times `latency`
+        fixtures -- a dict of data to serve per endpoint, laid out like DEFAULT_FIXTURES. Endpoints
+        it leaves out are served from DEFAULT_FIXTURES
+        proteins -- the number of proteins each gene has. Defaults to DEFAULT_PROTEINS
+        port -- the port to listen on. 0 picks a free one
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.retryAfter = retryAfter
+        self.slowRate = slowRate
+        self.slowLatency = slowLatency if slowLatency is not None else latency * 10
+        self.fixtures = dict(self.DEFAULT_FIXTURES)
+        self.fixtures.update(fixtures or {})
+        self.proteins = proteins if proteins is not None else self.DEFAULT_PROTEINS
+        self.port = port
+        self.server = None
+        self.thread = None
+        self.process = None
+        self.lock = threading.Lock()
+        self.reset()
+
+        # Everything needed to build the same server in a child process
+        self.settings = {'latency': latency, 'jitter': jitter, 'errorRate': errorRate, 'retryAfter': retryAfter,
+                         'slowRate': slowRate, 'slowLatency': slowLatency, 'fixtures': fixtures,
+                         'proteins': proteins, 'port': port}
+
+    def start (self):
+        """Starts serving on a background thread. Returns the root URL, e.g. http://127.0.0.1:8080"""
+        self.server = MockServer(('127.0.0.1', self.port), MockHandler)
+        self.server.mock = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.root()
+
+    def startProcess (self):
+        """Starts serving from a child process. Returns the root URL
+
+        stats() and reset() keep working, by asking the child over HTTP.
+        """
+        parentEnd, childEnd = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve, args=(self.settings, childEnd), daemon=True)
+        self.process.start()
+        self.port = parentEnd.recv()
+        return self.root()
+
+    def stop (self):
+        """Stops serving and closes the listening socket"""
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.process:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def root (self):
+        """Returns the root URL of the server"""
+        return 'http://127.0.0.1:%d' % self.port
+
+    def reset (self):
+        """Forgets every request counted so far"""
+        if self.process:
+            self.control('reset')
+            return
+
+        with self.lock:
+            self.counts = collections.Counter()
+            self.errors = 0
+            self.bytes = 0
+            self.serviceTimes = []
+
+    def stats (self):
+        """Returns what the server has seen since it started (or was last reset)
+
+        Return:
+        a dict with 'requests' (the total), 'byEndpoint' (requests per endpoint),
+        'errors' (503s served), 'bytes' (body bytes served) and 'serviceTimes' (the
+        seconds taken to answer each request, in the order they finished)
+        """
+        if self.process:
+            return self.control('stats')
+
+        with self.lock:
+            return {'requests': sum(self.counts.values()),
+                    'byEndpoint': dict(self.counts),
+                    'errors': self.errors,
+                    'bytes': self.bytes,
+                    'serviceTimes': list(self.serviceTimes)}
+
+    def control (self, command):
+        """Sends `command` ('stats' or 'reset') to the server in the child process, and returns its decoded answer"""
+        with urllib.request.urlopen(self.root() + '/_mock/' + command) as r:
+            return json.loads(r.read().decode())
+
+    def respond (self, path):
+        """Works out the answer to a GET of `path`. Called by MockHandler on the connection's thread
+
+        Return:
+        a tuple of (status, headers, body), where body is bytes
+        """
+        start = time.time()
+        parts = path.strip('/').split('/')
+
+        # The control URLs used by a MockWormBase in the parent process. They are
+        # answered straight away and not counted
+        if parts[0] == '_mock':
+            if parts[-1] == 'reset':
+                self.reset()
+            return 200, {'Content-Type': 'application/json'}, json.dumps(self.stats()).encode()
+
+        if random.random() < self.slowRate:
+            time.sleep(self.slowLatency)
+        else:
+            time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        if random.random() < self.errorRate:
+            status, headers, body = 503, {'Content-Type': 'text/html'}, b'<html>Service Unavailable</html>'
+            if self.retryAfter is not None:
+                headers['Retry-After'] = str(self.retryAfter)
+        else:
+            j = self.payload(parts)
+            if j is None:
+                status, j = 404, {'error': 'not found'}
+            else:
+                status = 200
+            headers, body = {'Content-Type': 'application/json'}, json.dumps(j).encode()
+
+        # Paths look like rest/field/gene/{id}/{datum}, so the endpoint is
+        # counted as e.g. 'gene/concise_description' or 'widget/overview'
+        if len(parts) == 5:
+            endpoint = (parts[1] if parts[1] == 'widget' else parts[2]) + '/' + parts[4]
+        else:
+            endpoint = 'other'
+        with self.lock:
+            self.counts[endpoint] += 1
+            self.bytes += len(body)
+            if status == 503:
+                self.errors += 1
+            self.serviceTimes.append(time.time() - start)
+
+        return status, headers, body
+
+    def payload (self, parts):
+        """Builds the JSON body for the path split into `parts`, or None if the path isn't one WormBase would serve"""
+        if len(parts) != 5 or parts[0] != 'rest':
+            return None
+        kind, base, id, datum = parts[1], parts[2], parts[3], parts[4]
+
+        if kind == 'field' and base == 'gene' and datum in WormCSV.WormData.GENE_FIELDS:
+            return {datum: {'data': self.fieldData(id, datum)}}
+        if kind == 'field' and base == 'protein' and datum == 'best_human_match':
+            return {datum: {'data': self.fieldData(id, datum)}}
+        if kind == 'widget' and base == 'gene' and datum in WormCSV.WormData.WIDGETS:
+            fields = dict((field, {'data': self.fieldData(id, field)}) for field in WormCSV.WormData.WIDGETS[datum])
+            return {'name': datum, 'fields': fields}
+        return None
+
+    def fieldData (self, id, datum):
+        """Returns the 'data' value of one endpoint for the gene or protein `id`"""
+        if datum == 'gene_models' and datum not in self.fixtures:
+            return {'table': [{'protein': {'id': 'CE%s_%d' % (id, i)}} for i in range(self.proteins)]}
+        return self.fillIn(self.fixtures.get(datum), id)
+
+    def fillIn (self, template, id):
+        """Copies a fixture, replacing '{id}' in every string with `id`"""
+        if isinstance(template, str):
+            return template.replace('{id}', id)
+        if isinstance(template, list):
+            return [self.fillIn(item, id) for item in template]
+        if isinstance(template, dict):
+            return dict((key, self.fillIn(value, id)) for key, value in template.items())
+        return template
+
+
+def serve (settings, connection):
+    """Runs a MockWormBase until the process is terminated. The target of MockWormBase.startProcess()
+
+    Arguments:
+    settings -- the keyword arguments for the MockWormBase
+    connection -- one end of a multiprocessing.Pipe. The port the server listens on is sent down it
+    """
+    mock = MockWormBase(**settings)
+    mock.start()
+    connection.send(mock.port)
+    mock.thread.join()
@@ -0,0 +1,898 @@
+import json
+import threading
+import concurrent.futures
+import time
+import random
+import collections
+
+# requests, asyncio and aiohttp take longer to import than the rest of WormBait
+# put together, and none of them is needed until the first request is made, so
+# they are imported then instead of here. See loadRequests() and loadAiohttp()
+requests = None
+asyncio = None
+aiohttp = None
+aiohttpLoaded = False
+
+"""The WormNet module holds the network layer that WormBait uses to talk to WormBase
+
+The classes in this module know nothing about genes or proteins. They make HTTP
+requests and hand back decoded JSON; turning that JSON into WormBait data is left
+to WormCSV.WormData.
+"""
+
+def loadRequests ():
+    """Imports requests, if it hasn't been already. Called before the first blocking request is made"""
+    global requests
+    if requests is None:
+        import requests.adapters
+    return requests
+
+def loadAiohttp ():
+    """Imports asyncio and aiohttp, if they haven't been already. Called before the asyncio backend is used
+
+    aiohttp is only needed for the asyncio backend. WormBait runs without it,
+    using the blocking requests library instead.
+
+    Return:
+    the aiohttp module, or None if it is not installed
+    """
+    global asyncio, aiohttp, aiohttpLoaded
+    if not aiohttpLoaded:
+        import asyncio
+        try:
+            import aiohttp
+        except ImportError:
+            aiohttp = None
+        aiohttpLoaded = True
+    return aiohttp
+
+
+class AdaptiveLimiter ():
+    """Adjusts how many requests may be in flight at once, based on how WormBase is coping
+
+    The limiter follows the AIMD scheme used by TCP: every request that comes
+    back quickly and successfully raises the limit a little (by about one per
+    round of requests), and a sign of overload (a 429 or 5xx response, a timeout,
+    a dropped connection, or a response slower than targetLatency) halves it. A
+    Retry-After header pauses every request until the time it asks for.
+
+    Requests must call acquire() before they are sent and release() once they
+    have finished. On the asyncio backend, acquireAsync() is used in place of
+    acquire(). The current limit can be read at any time with currentLimit().
+
+    Since every request goes through it, the limiter is also where a run is
+    paused and cancelled. pause() holds back every request not yet sent until
+    resume(), while requests already in flight finish as usual; close() makes
+    every request not yet sent fail at once with RunCancelled, so a cancelled
+    run winds down without sending anything more. open() undoes both, ready
+    for the next run.
+
+    A request may give acquire() a timeout, so the wait for the limiter counts
+    towards its deadline. Time spent paused doesn't: that is the user's doing,
+    not WormBase's, and a long pause shouldn't fail every request held back by
+    it. pausedTime() and activeTime() let callers leave it out of their own
+    deadlines the same way.
+    """
+
+    DEFAULT_INITIAL = 8
+    """The limit a new limiter starts at"""
+
+    DEFAULT_TARGET_LATENCY = 5.0
+    """Seconds. Responses slower than this are taken as a sign of overload"""
+
+    DECREASE = 0.5
+    """What the limit is multiplied by on overload"""
+
+    def __init__ (self, initial=None, minimum=1, maximum=64, targetLatency=None):
+        """Constructs an AdaptiveLimiter
+
+        Arguments:
+        initial -- the starting limit. Defaults to DEFAULT_INITIAL
+        minimum -- the limit never goes below this
+        maximum -- the limit never goes above this
+        targetLatency -- seconds a healthy response should take. Defaults to DEFAULT_TARGET_LATENCY
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial or self.DEFAULT_INITIAL, minimum), maximum))
+        self.targetLatency = targetLatency or self.DEFAULT_TARGET_LATENCY
+        self.inFlight = 0
+        self.pausedUntil = 0
+        self.lastDecrease = 0
+        self.paused = False
+        self.pausedAt = None
+        self.pausedSeconds = 0.0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.asyncWaiters = []
+        self.loop = None
+
+    def currentLimit (self):
+        """Returns the number of requests currently allowed in flight at once"""
+        return int(self.limit)
+
+    def waitTime (self):
+        """Returns 0 if a request may be sent now, the seconds left if paused by Retry-After, or None if the limit is
+        reached or the limiter is paused. Raises RunCancelled if the limiter is closed"""
+        now = time.time()
+        if self.closed:
+            raise RunCancelled('run cancelled')
+        if self.paused:
+            return None
+        if now < self.pausedUntil:
+            return self.pausedUntil - now
+        if self.inFlight >= int(self.limit):
+            return None
+        return 0
+
+    def update (self, latency, overloaded, retryAfter):
+        """Adjusts the limit after a request has finished. Call with the lock held"""
+        now = time.time()
+        if retryAfter:
+            self.pausedUntil = max(self.pausedUntil, now + retryAfter)
+
+        if overloaded or latency > self.targetLatency:
+            # Every request that was in flight during a bad spell will report it.
+            # Only cut the limit once per round trip, so one spell halves it once
+            if now - self.lastDecrease > latency:
+                self.limit = max(self.minimum, self.limit * self.DECREASE)
+                self.lastDecrease = now
+        else:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def timedWait (self, wait, timeout, start, pausedStart):
+        """Shortens the wait from waitTime() to what is left of `timeout`, if there is one. Call with the lock held
+
+        Raises FetchError if the timeout has run out. While the limiter is paused, the timeout is
+        on hold, so the wait is left as it is.
+        """
+        if timeout is None or self.paused:
+            return wait
+        left = timeout - self.activeTime(start, pausedStart)
+        if left <= 0:
+            raise FetchError('timed out waiting for the request limit')
+        return left if wait is None else min(wait, left)
+
+    def acquire (self, timeout=None):
+        """Blocks until a request may be sent, then counts it as in flight
+
+        Raises RunCancelled if the limiter is closed, or FetchError if `timeout` seconds
+        (not counting any time paused) pass first.
+        """
+        start = time.time()
+        pausedStart = self.pausedTime()
+        with self.condition:
+            while True:
+                wait = self.waitTime()
+                if wait == 0:
+                    self.inFlight += 1
+                    return
+                self.condition.wait(self.timedWait(wait, timeout, start, pausedStart))
+
+    def release (self, latency, overloaded=False, retryAfter=None):
+        """Records how a request went and lets the next one through
+
+        release() never blocks for long, so the asyncio backend calls it directly
+        too. That matters when a request is cancelled (a hedged request that lost
+        the race, say): its slot is handed back at once rather than waiting on a
+        lock that the cancellation could interrupt.
+
+        Arguments:
+        latency -- seconds the request took
+        overloaded -- True if the request failed in a way that suggests WormBase is overloaded
+        retryAfter -- seconds from a Retry-After header, if there was one
+        """
+        with self.condition:
+            self.inFlight -= 1
+            self.update(latency, overloaded, retryAfter)
+            self.condition.notify_all()
+            waiters, self.asyncWaiters = self.asyncWaiters, []
+
+        self.wakeWaiters(waiters)
+
+    def pause (self):
+        """Holds back every request not yet sent until resume() is called. Safe to call from any thread"""
+        with self.condition:
+            if not self.paused:
+                self.paused = True
+                self.pausedAt = time.time()
+
+    def resume (self):
+        """Lets requests held back by pause() go. Safe to call from any thread"""
+        with self.condition:
+            self.unpause()
+        self.wakeAll()
+
+    def unpause (self):
+        """Ends a pause, adding it to the time spent paused. Call with the lock held"""
+        if self.paused:
+            self.pausedSeconds += time.time() - self.pausedAt
+            self.paused = False
+
+    def pausedTime (self):
+        """Returns the total seconds the limiter has been paused, including a pause still going on"""
+        with self.condition:
+            if self.paused:
+                return self.pausedSeconds + time.time() - self.pausedAt
+            return self.pausedSeconds
+
+    def activeTime (self, start, pausedStart):
+        """Returns the seconds since `start` (a time.time()) that the limiter wasn't paused
+
+        Arguments:
+        start -- when the period began
+        pausedStart -- what pausedTime() returned at `start`
+        """
+        return time.time() - start - (self.pausedTime() - pausedStart)
+
+    def close (self):
+        """Makes every request not yet sent, including any held back by pause(), raise RunCancelled. Safe to call
+        from any thread"""
+        with self.condition:
+            self.closed = True
+        self.wakeAll()
+
+    def open (self):
+        """Undoes pause() and close(), ready for a new run"""
+        with self.condition:
+            self.unpause()
+            self.closed = False
+        self.wakeAll()
+
+    def wakeAll (self):
+        """Wakes every request waiting in acquire() or acquireAsync(), so it looks again at whether it may go
+
+        The async waiters belong to the event loop, so when called from another
+        thread (the Tk thread pressing Pause, say) they are woken on the loop.
+        """
+        with self.condition:
+            self.condition.notify_all()
+            waiters, self.asyncWaiters = self.asyncWaiters, []
+
+        if waiters and self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wakeWaiters, waiters)
+
+    def wakeWaiters (self, waiters):
+        """Resolves the futures of waiting acquireAsync() calls. Must run on their event loop"""
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def startAsync (self):
+        """Prepares the limiter for use on the currently running event loop. Called by AsyncFetcher"""
+        self.asyncWaiters = []
+        self.loop = asyncio.get_event_loop()
+
+    async def acquireAsync (self, timeout=None):
+        """Coroutine version of acquire()"""
+        loop = asyncio.get_event_loop()
+        start = time.time()
+        pausedStart = self.pausedTime()
+        while True:
+            with self.condition:
+                wait = self.waitTime()
+                if wait == 0:
+                    self.inFlight += 1
+                    return
+                wait = self.timedWait(wait, timeout, start, pausedStart)
+                waiter = loop.create_future()
+                self.asyncWaiters.append(waiter)
+
+            # Woken by the next release(), or once a Retry-After pause runs out
+            try:
+                await asyncio.wait_for(waiter, wait)
+            except asyncio.TimeoutError:
+                pass
+
+
+def isOverloaded (status):
+    """Identifies the HTTP status codes that mean the server is struggling"""
+    return status == 429 or status >= 500
+
+def parseRetryAfter (value):
+    """Turns the value of a Retry-After header (seconds or an HTTP date) into seconds from now. None if absent or unreadable"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class FetchError (Exception):
+    """Raised when a request could not be completed, even after retrying"""
+
+    def __init__ (self, reason):
+        Exception.__init__(self, reason)
+        self.reason = reason
+
+
+class RunCancelled (FetchError):
+    """Raised in place of sending a request once the run it belongs to has been cancelled. See AdaptiveLimiter.close()"""
+
+
+class RetryableError (FetchError):
+    """Raised by a single attempt at a request that failed in a way worth retrying"""
+
+    def __init__ (self, reason, retryAfter=None):
+        FetchError.__init__(self, reason)
+        self.retryAfter = retryAfter
+
+
+class RetryPolicy ():
+    """Describes how hard a request is tried before it is given up on
+
+    Failed attempts (timeouts, dropped connections, and 429 and 5xx responses) are
+    retried after a randomly jittered, exponentially growing delay, up to a number of
+    attempts and within an overall deadline. Any other response that isn't JSON, such
+    as an HTML 404 page, won't be any different next time, so it fails at once.
+    Optionally, a request that is slower than 95% of recent requests is hedged:
+    a duplicate is sent, and whichever answers first is used.
+    """
+
+    DEFAULT_ATTEMPTS = 4
+    """The most times a request is tried"""
+
+    DEFAULT_BASE_DELAY = 0.5
+    """Seconds. The delay before the first retry is up to this, and doubles for each retry after it"""
+
+    DEFAULT_MAX_DELAY = 30
+    """Seconds. No delay between retries is longer than this (unless Retry-After asks for it)"""
+
+    DEFAULT_DEADLINE = 180
+    """Seconds a request may take in total, across every attempt"""
+
+    def __init__ (self, attempts=None, baseDelay=None, maxDelay=None, deadline=None, hedge=False):
+        """Constructs a RetryPolicy. Every argument defaults to the matching DEFAULT_ value
+
+        Arguments:
+        attempts -- the most times a request is tried
+        baseDelay -- seconds of delay before the first retry, at most
+        maxDelay -- the longest delay between retries
+        deadline -- seconds a request may take in total, including every wait for the limiter
+        but not any time the run is paused
+        hedge -- True to send a duplicate of any request slower than the 95th percentile
+        """
+        # Zero is a meaningful setting for any of these, so only None means the default
+        self.attempts = self.DEFAULT_ATTEMPTS if attempts is None else attempts
+        self.baseDelay = self.DEFAULT_BASE_DELAY if baseDelay is None else baseDelay
+        self.maxDelay = self.DEFAULT_MAX_DELAY if maxDelay is None else maxDelay
+        self.deadline = self.DEFAULT_DEADLINE if deadline is None else deadline
+        self.hedge = hedge
+
+    def delay (self, attempt, retryAfter=None):
+        """Returns the seconds to wait before retrying after failed attempt number `attempt` (counting from 1)"""
+        delay = random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** (attempt - 1)))
+        if retryAfter:
+            delay = max(delay, retryAfter)
+        return delay
+
+
+class LatencyTracker ():
+    """Keeps the latencies of recent successful requests, to tell when a request is unusually slow"""
+
+    SAMPLES = 500
+    """How many recent latencies are kept"""
+
+    MINIMUM_SAMPLES = 20
+    """Percentiles aren't reported until this many latencies have been seen"""
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=self.SAMPLES)
+
+    def record (self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def percentile (self, fraction):
+        """Returns the given percentile (e.g. 0.95) of recent latencies, or None if there aren't enough yet"""
+        with self.lock:
+            if len(self.latencies) < self.MINIMUM_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def describeException (e):
+    """A short description of a failed request, for the record of failures"""
+    return '%s: %s' % (type(e).__name__, e) if str(e) else type(e).__name__
+
+
+class Transport ():
+    """The shared HTTP transport used for every blocking request in a run
+
+    A Transport wraps a single requests.Session, so connections to WormBase are
+    kept alive and reused between requests instead of being opened anew every
+    time. Every WormData in a run should share one Transport. It also enforces
+    timeouts, so that a stalled connection fails instead of hanging the run, and
+    paces every request through an AdaptiveLimiter so WormBase is never pushed
+    harder than it can take. getJson() adds retries, a deadline and optional
+    hedging on top, as described by a RetryPolicy.
+    """
+
+    DEFAULT_POOL_SIZE = 4
+    """How many hosts keep a pool of open connections"""
+
+    DEFAULT_PER_HOST = 64
+    """The most connections open to any one host at once"""
+
+    DEFAULT_CONNECT_TIMEOUT = 10
+    """Seconds to wait for a connection to be established"""
+
+    DEFAULT_READ_TIMEOUT = 60
+    """Seconds to wait between bytes of the response"""
+
+    CHUNK_SIZE = 64 * 1024
+    """Bytes of a response body read at a time. The deadline is checked between chunks"""
+
+    def __init__ (self, poolSize=None, perHost=None, connectTimeout=None, readTimeout=None, limiter=None,
+                  retry=None):
+        """Constructs a Transport
+
+        Arguments:
+        poolSize -- the number of hosts to keep connection pools for. Defaults to DEFAULT_POOL_SIZE
+        perHost -- the most connections open to one host. Requests beyond this wait for a free
+        connection. Defaults to DEFAULT_PER_HOST
+        connectTimeout -- seconds to wait for a connection. Defaults to DEFAULT_CONNECT_TIMEOUT
+        readTimeout -- seconds to wait for the server to send data. Defaults to DEFAULT_READ_TIMEOUT
+        limiter -- the AdaptiveLimiter that paces requests. Defaults to one that can grow up to perHost
+        retry -- the RetryPolicy for getJson(). Defaults to RetryPolicy()
+        """
+        # As with RetryPolicy, only None means the default. A 0 is an error, not a
+        # request for the default, since no request could ever be made with it
+        self.poolSize = self.DEFAULT_POOL_SIZE if poolSize is None else poolSize
+        self.perHost = self.DEFAULT_PER_HOST if perHost is None else perHost
+        self.connectTimeout = self.DEFAULT_CONNECT_TIMEOUT if connectTimeout is None else connectTimeout
+        self.readTimeout = self.DEFAULT_READ_TIMEOUT if readTimeout is None else readTimeout
+        if self.poolSize < 1 or self.perHost < 1:
+            raise ValueError('poolSize and perHost must be at least 1')
+        if self.connectTimeout <= 0 or self.readTimeout <= 0:
+            raise ValueError('connectTimeout and readTimeout must be more than 0')
+        self.limiter = limiter or AdaptiveLimiter(maximum=self.perHost)
+        self.retry = retry or RetryPolicy()
+        self.latencies = LatencyTracker()
+        self.hedgeExecutor = None
+        self.hedgeLock = threading.Lock()
+
+        # Opened by the first request, so that a Transport costs nothing until it is used
+        self.session = None
+        self.sessionLock = threading.Lock()
+
+    def openSession (self):
+        """Opens the pooled requests.Session, if it isn't open already, and returns it"""
+        with self.sessionLock:
+            if self.session is None:
+                loadRequests()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.poolSize,
+                                                        pool_maxsize=self.perHost,
+                                                        pool_block=True)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session = session
+            return self.session
+
+    def get (self, url, headers=None, timeout=None):
+        """Makes an HTTP GET request over a pooled connection
+
+        Raises requests.exceptions.Timeout (or ConnectionError) if the server does not answer
+        in time, and FetchError if the limiter holds the request back for all of `timeout`.
+
+        Arguments:
+        url -- the full URL to request
+        headers -- optional dict of HTTP headers to send
+        timeout -- seconds the whole request may take, from waiting for the limiter to
+        reading the last of the body. None for no limit beyond the connect and read timeouts
+
+        Return:
+        the requests.Response and its body, as bytes
+        """
+        session = self.session or self.openSession()
+        start = time.time()
+        pausedStart = self.limiter.pausedTime()
+        self.limiter.acquire(timeout)
+
+        connectTimeout, readTimeout = self.connectTimeout, self.readTimeout
+        deadline = None
+        if timeout is not None:
+            left = max(timeout - self.limiter.activeTime(start, pausedStart), 0.001)
+            deadline = time.time() + left
+            connectTimeout, readTimeout = min(connectTimeout, left), min(readTimeout, left)
+
+        start = time.time()
+        try:
+            # The body is read here, a chunk at a time, so that one trickling in
+            # can't hold the request past its deadline
+            r = session.get(url, headers=headers, timeout=(connectTimeout, readTimeout), stream=True)
+            try:
+                chunks = []
+                for chunk in self.readBody(r):
+                    chunks.append(chunk)
+                    if deadline is not None and time.time() > deadline:
+                        raise requests.exceptions.Timeout('the response took longer than its deadline')
+            finally:
+                r.close()
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+            self.limiter.release(time.time() - start, overloaded=True)
+            raise
+        except:
+            self.limiter.release(time.time() - start)
+            raise
+
+        self.limiter.release(time.time() - start, isOverloaded(r.status_code),
+                             parseRetryAfter(r.headers.get('Retry-After')))
+        return r, b''.join(chunks)
+
+    def readBody (self, r):
+        """Yields the body of a streamed response as it arrives, up to CHUNK_SIZE bytes at a time
+
+        urllib3 2 can hand over whatever has arrived so far (read1()), so a body
+        trickling in is seen a little at a time. Older versions wait for a whole
+        chunk (or the end of the body) before handing any of it over.
+        """
+        if not hasattr(r.raw, 'read1'):
+            for chunk in r.iter_content(self.CHUNK_SIZE):
+                yield chunk
+            return
+
+        import urllib3.exceptions
+        try:
+            while True:
+                chunk = r.raw.read1(self.CHUNK_SIZE, decode_content=True)
+                if not chunk:
+                    return
+                yield chunk
+        # As iter_content() would, urllib3's errors are reported as requests' own
+        except urllib3.exceptions.ReadTimeoutError as e:
+            raise requests.exceptions.ReadTimeout(e)
+        except urllib3.exceptions.HTTPError as e:
+            raise requests.exceptions.ConnectionError(e)
+
+    def getJson (self, url, headers=None):
+        """Makes an HTTP GET request, retrying as the RetryPolicy allows, and returns the decoded JSON body
+
+        Raises FetchError if no attempt succeeded before the attempts or the deadline ran out.
+
+        Arguments:
+        url -- the full URL to request
+        headers -- optional dict of HTTP headers to send
+        """
+        return self.getJsonAndSize(url, headers)[0]
+
+    def getJsonAndSize (self, url, headers=None):
+        """Does the work of getJson(). Returns a tuple of the decoded JSON body and the size of the body in bytes"""
+        start = time.time()
+        pausedStart = self.limiter.pausedTime()
+        attempt = 0
+        while True:
+            remaining = self.retry.deadline - self.limiter.activeTime(start, pausedStart)
+            try:
+                return self.attemptHedged(url, headers, remaining)
+            except RetryableError as e:
+                attempt += 1
+                delay = self.retry.delay(attempt, e.retryAfter)
+                if (attempt >= self.retry.attempts or
+                        self.limiter.activeTime(start, pausedStart) + delay >= self.retry.deadline):
+                    raise FetchError('%s (gave up after %d attempts)' % (e.reason, attempt))
+                time.sleep(delay)
+
+    def attempt (self, url, headers, remaining):
+        """Makes a single attempt at a request. Returns the decoded JSON body and its size
+
+        Raises RetryableError if the attempt is worth repeating, or FetchError if it isn't.
+        """
+        start = time.time()
+        try:
+            r, body = self.get(url, headers, remaining)
+        except requests.exceptions.RequestException as e:
+            raise RetryableError(describeException(e))
+
+        if isOverloaded(r.status_code):
+            raise RetryableError('HTTP %d' % r.status_code, parseRetryAfter(r.headers.get('Retry-After')))
+
+        try:
+            j = json.loads(body)
+        except ValueError:
+            raise FetchError('HTTP %d, response was not JSON' % r.status_code)
+
+        self.latencies.record(time.time() - start)
+        return j, len(body)
+
+    def attemptHedged (self, url, headers, remaining):
+        """Makes an attempt at a request, hedging it with a duplicate if it is slower than usual
+
+        Without hedging (or before enough latencies are known) this is just attempt().
+        Otherwise the attempt runs on a helper thread. If it hasn't answered by the 95th
+        percentile of recent latencies, a duplicate is sent, and the first success wins.
+        The loser can't be cancelled, so it simply finishes in the background.
+        """
+        hedgeAfter = self.retry.hedge and self.latencies.percentile(0.95)
+        if not hedgeAfter:
+            return self.attempt(url, headers, remaining)
+
+        with self.hedgeLock:
+            if self.hedgeExecutor is None:
+                self.hedgeExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=self.perHost * 2)
+
+        primary = self.hedgeExecutor.submit(self.attempt, url, headers, remaining)
+        done, pending = concurrent.futures.wait([primary], timeout=hedgeAfter)
+        if done:
+            return primary.result()
+
+        pending = set([primary, self.hedgeExecutor.submit(self.attempt, url, headers, remaining - hedgeAfter)])
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    def close (self):
+        """Closes every pooled connection"""
+        if self.session:
+            self.session.close()
+            self.session = None
+        if self.hedgeExecutor:
+            self.hedgeExecutor.shutdown(wait=False)
+
+
+defaultTransportLock = threading.Lock()
+defaultTransportInstance = None
+
+def defaultTransport ():
+    """Returns the Transport shared by every WormData that isn't given one explicitly"""
+    global defaultTransportInstance
+    with defaultTransportLock:
+        if defaultTransportInstance is None:
+            defaultTransportInstance = Transport()
+        return defaultTransportInstance
+
+
+class Coalescer ():
+    """Makes sure each distinct request is only made once per run
+
+    Every request is identified by a key (WormData uses the base URL, ID and
+    datum). The first caller with a given key makes the request. Anyone who asks
+    for the same key while that request is still in flight waits for it and gets
+    the same result. Once a request has finished it is moved to a small list of
+    recent results, so that anyone who asks shortly afterwards (another gene
+    sharing a protein, say) still gets it straight away; only the MAX_FINISHED
+    most recently used are kept, so memory stays bounded however long the run
+    is. A Coalescer should live exactly as long as one run.
+
+    The blocking and asyncio backends each keep their own set of requests, so one
+    Coalescer can safely be used by either.
+    """
+
+    MAX_FINISHED = 1000
+    """How many finished requests are kept for later callers, per backend"""
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.finished = collections.OrderedDict()
+        self.asyncFutures = {}
+        self.asyncFinished = collections.OrderedDict()
+
+    def remember (self, finished, key, future):
+        """Adds a finished request to `finished`, forgetting the least recently used beyond MAX_FINISHED"""
+        finished[key] = future
+        finished.move_to_end(key)
+        while len(finished) > self.MAX_FINISHED:
+            finished.popitem(last=False)
+
+    def call (self, key, fn, *args):
+        """Returns fn(*args), unless a call with the same key is in flight or finished recently
+
+        If the call raises, the exception is passed on to every caller waiting on it.
+        """
+        with self.lock:
+            future = self.finished.get(key)
+            if future is not None:
+                self.finished.move_to_end(key)
+                owner = False
+            else:
+                future = self.futures.get(key)
+                owner = future is None
+                if owner:
+                    future = concurrent.futures.Future()
+                    self.futures[key] = future
+
+        if owner:
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+            # Every waiter already holds the future, so it can leave the in-flight table
+            with self.lock:
+                del self.futures[key]
+                self.remember(self.finished, key, future)
+
+        return future.result()
+
+    async def callAsync (self, key, coroutineFn, *args):
+        """Coroutine version of call(). Awaits coroutineFn(*args) unless the same key is in flight or finished recently"""
+        task = self.asyncFinished.get(key)
+        if task is not None:
+            self.asyncFinished.move_to_end(key)
+        else:
+            task = self.asyncFutures.get(key)
+            if task is None:
+                task = asyncio.ensure_future(coroutineFn(*args))
+                self.asyncFutures[key] = task
+                task.add_done_callback(lambda task: self.finishedAsync(key, task))
+
+        # shield() keeps one cancelled waiter from cancelling the request for everyone else
+        return await asyncio.shield(task)
+
+    def finishedAsync (self, key, task):
+        """Moves a finished request from the in-flight table to the recent results. A cancelled one is just dropped"""
+        if self.asyncFutures.get(key) is task:
+            del self.asyncFutures[key]
+        if not task.cancelled():
+            self.remember(self.asyncFinished, key, task)
+
+
+class AsyncFetcher ():
+    """Performs WormBase API requests from an asyncio event loop
+
+    A single AsyncFetcher can keep thousands of requests in flight on one thread.
+    The number of requests in flight at any moment is capped by a semaphore, so
+    the whole run shares one global limit no matter how many genes are in progress.
+    The connection limit per host, the timeouts and the AdaptiveLimiter are taken
+    from a Transport, so both backends are tuned (and throttled) the same way.
+    The fetcher must be entered with `async with` before use; this opens the
+    underlying aiohttp session, and leaving the block closes it.
+    """
+
+    DEFAULT_CONCURRENCY = 200
+    """The number of requests in flight at once when no limit is given"""
+
+    def __init__ (self, concurrency=None, transport=None):
+        """Constructs an AsyncFetcher
+
+        Arguments:
+        concurrency -- the most requests allowed in flight at once. Defaults to DEFAULT_CONCURRENCY
+        transport -- a Transport whose per-host limit and timeouts should also apply here. Defaults
+        to the shared default transport
+        """
+        if loadAiohttp() is None:
+            raise RuntimeError('The asyncio backend requires the aiohttp package')
+
+        self.concurrency = concurrency or self.DEFAULT_CONCURRENCY
+        self.transport = transport or defaultTransport()
+        self.semaphore = None
+        self.session = None
+
+    async def __aenter__ (self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.transport.perHost)
+        timeout = aiohttp.ClientTimeout(sock_connect=self.transport.connectTimeout,
+                                        sock_read=self.transport.readTimeout)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self.transport.limiter.startAsync()
+        return self
+
+    async def __aexit__ (self, *ignore):
+        await self.session.close()
+        self.session = None
+
+    async def getJson (self, url, headers=None):
+        """Coroutine version of Transport.getJson(), following the transport's RetryPolicy
+
+        Raises FetchError if no attempt succeeded before the attempts or the deadline ran out.
+
+        Arguments:
+        url -- the full URL to request
+        headers -- optional dict of HTTP headers to send
+        """
+        return (await self.getJsonAndSize(url, headers))[0]
+
+    async def getJsonAndSize (self, url, headers=None):
+        """Coroutine version of Transport.getJsonAndSize()"""
+        retry = self.transport.retry
+        limiter = self.transport.limiter
+        start = time.time()
+        pausedStart = limiter.pausedTime()
+        attempt = 0
+        while True:
+            remaining = retry.deadline - limiter.activeTime(start, pausedStart)
+            try:
+                return await self.attemptHedged(url, headers, remaining)
+            except RetryableError as e:
+                attempt += 1
+                delay = retry.delay(attempt, e.retryAfter)
+                if attempt >= retry.attempts or limiter.activeTime(start, pausedStart) + delay >= retry.deadline:
+                    raise FetchError('%s (gave up after %d attempts)' % (e.reason, attempt))
+                await asyncio.sleep(delay)
+
+    async def attempt (self, url, headers, remaining):
+        """Coroutine version of Transport.attempt()"""
+        limiter = self.transport.limiter
+        start = time.time()
+        pausedStart = limiter.pausedTime()
+        async with self.semaphore:
+            # Every wait so far, for the semaphore and the limiter, comes out of the
+            # time the request itself may take
+            await limiter.acquireAsync(remaining - limiter.activeTime(start, pausedStart))
+            left = max(remaining - limiter.activeTime(start, pausedStart), 0.001)
+            timeout = aiohttp.ClientTimeout(total=left, sock_connect=min(self.transport.connectTimeout, left),
+                                            sock_read=min(self.transport.readTimeout, left))
+            start = time.time()
+            try:
+                async with self.session.get(url, headers=headers, timeout=timeout) as r:
+                    status = r.status
+                    retryAfter = parseRetryAfter(r.headers.get('Retry-After'))
+                    j = None
+                    size = 0
+                    decoded = False
+                    if not isOverloaded(status):
+                        # WormBase doesn't always label its JSON as such, so the body is
+                        # decoded here rather than by aiohttp, which checks the content type
+                        body = await r.read()
+                        size = len(body)
+                        try:
+                            j = json.loads(body)
+                            decoded = True
+                        except ValueError:
+                            pass
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                limiter.release(time.time() - start, overloaded=True)
+                raise RetryableError(describeException(e))
+            except:
+                limiter.release(time.time() - start)
+                raise
+
+            latency = time.time() - start
+            limiter.release(latency, isOverloaded(status), retryAfter)
+
+        if isOverloaded(status):
+            raise RetryableError('HTTP %d' % status, retryAfter)
+        if not decoded:
+            raise FetchError('HTTP %d, response was not JSON' % status)
+
+        self.transport.latencies.record(latency)
+        return j, size
+
+    async def attemptHedged (self, url, headers, remaining):
+        """Coroutine version of Transport.attemptHedged(). Here the losing request is cancelled"""
+        hedgeAfter = self.transport.retry.hedge and self.transport.latencies.percentile(0.95)
+        if not hedgeAfter:
+            return await self.attempt(url, headers, remaining)
+
+        pending = set([asyncio.ensure_future(self.attempt(url, headers, remaining))])
+        try:
+            done, pending = await asyncio.wait(pending, timeout=hedgeAfter)
+            if done:
+                return done.pop().result()
+
+            pending.add(asyncio.ensure_future(self.attempt(url, headers, remaining - hedgeAfter)))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Look at every finished task before returning, so that a failure
+                # which finished alongside a success is still retrieved
+                winner = None
+                for task in done:
+                    if task.exception() is None:
+                        winner = winner or task
+                    else:
+                        error = error or task.exception()
+                if winner:
+                    return winner.result()
+            raise error
+        finally:
+            # A loser can still finish (with an error) if the cancellation races
+            # its last step, so its outcome is collected whenever it comes
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(lambda task: task.cancelled() or task.exception())
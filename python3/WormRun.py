@@ -0,0 +1,793 @@
+import concurrent.futures
+import re
+import os
+import json
+import hashlib
+import sys
+import threading
+import bisect
+import time
+import WormCSV
+import WormNet
+
+"""The WormRun module holds the engine that performs a WormBait run
+
+A run takes the list of IDs entered by the user, resolves each one to the
+WormBase gene IDs it stands for, and collects the data for every gene from
+WormBase. Many genes are collected at once, but the results always come back
+in the order the IDs were entered, and can be consumed as they arrive. The user interface only drives this engine;
+it never talks to WormBase itself.
+"""
+
+def collect_db_ids (rawText):
+    """Collects and scrubs the DB IDs from a block of text
+
+    After some effort, the IDs can now be separated by any combination of
+    newlines and commas. Whitespace is stripped from beginning and end
+    """
+    dbIds = rawText.split('\n') # Split up rows
+    dbIds = [re.compile("[ ,]").split(i) for i in dbIds] # Split apart rows by spaces
+    dbIds = [i for sublist in dbIds for i in sublist] # Flatten sublists into one level
+    cleanIds = [x.strip() for x in dbIds] # Remove whitespace from each ID
+    cleanIds = [_f for _f in cleanIds if _f] # Remove all empty IDs
+    return cleanIds
+
+def check_db_ids (db_ids):
+    """Identifies whether or not ALL of the DB IDs provided are WormBase gene IDs.
+
+    If every provided ID is a WormBase gene ID, WormBait will skip reading a provided
+    database file (since no DB will be needed to connect a DB ID to a WormBase gene ID).
+    """
+    exclusively_WB_IDs = True;
+
+    for x in db_ids:
+        if not 'WBGene' in x:
+            exclusively_WB_IDs = False
+            break
+
+    return exclusively_WB_IDs
+
+def parse_fields (text):
+    """Turns a comma- or space-separated list of field names into a list of fields
+
+    The names are those of WormCSV.WormData.FIELDS (which are also the output
+    columns). An empty list means every field. Raises ValueError for a name
+    that isn't a field. The fields come back in FIELDS order, whatever order
+    they were given in, so the same choice of fields always means the same run.
+    """
+    fields = [f.strip() for f in re.compile("[ ,]").split(text or '')]
+    fields = [f for f in fields if f]
+    for field in fields:
+        if field not in WormCSV.WormData.FIELDS:
+            raise ValueError('Unknown field: %s (choose from %s)' % (field, ', '.join(WormCSV.WormData.FIELDS)))
+    return [field for field in WormCSV.WormData.FIELDS if field in fields] or list(WormCSV.WormData.FIELDS)
+
+class WormBaitRun ():
+    """An object representing a single run of WormBait over a list of IDs"""
+
+    HEADERS = ['db_id', 'gene_id', 'up/down', 'sequence_name', 'protein_id',
+               'best_human_ortholog', 'description', 'gene_class', 'human_orthologs',
+               'nematode_orthologs', 'other_orthologs']
+    """Every column of the output CSV, in order. A run that collects only some fields writes only
+    their columns (see headers())"""
+
+    ID_HEADERS = ['db_id', 'gene_id', 'up/down']
+    """The columns that come from the input IDs and the CuffLink database rather than WormBase. They
+    are written whatever fields are chosen"""
+
+    DEFAULT_WORKERS = 8
+    """How many genes are collected at once when no worker count is given"""
+
+    BACKENDS = ['threads', 'asyncio']
+    """The ways a run can be performed. 'threads' uses blocking requests calls and is always available;
+    'asyncio' keeps every request of the run on a single event loop and needs aiohttp"""
+
+    def __init__ (self, ids, database=None, workers=None, backend='threads', concurrency=None, transport=None, cache=None,
+                  window=None, journal=None, previous=None, fields=None, strategy=None, stats=None):
+        """Constructs a WormBaitRun object. Nothing is fetched until run() or results() is called
+
+        Arguments:
+        ids -- the scrubbed list of IDs to collect data for. These may be DB IDs (like
+        XLOC IDs) or WormBase gene IDs
+
+        database -- the CuffLinkDatabase used to turn DB IDs into WormBase gene IDs. May be
+        None if every ID is already a WormBase gene ID
+
+        workers -- the number of genes to collect at once. Defaults to DEFAULT_WORKERS. Only used
+        by the 'threads' backend
+
+        backend -- one of BACKENDS. If 'asyncio' is requested but aiohttp is not installed, the
+        run falls back to 'threads'
+
+        concurrency -- the most API requests in flight at once. Only used by the 'asyncio' backend,
+        which otherwise uses WormNet.AsyncFetcher.DEFAULT_CONCURRENCY
+
+        transport -- the WormNet.Transport shared by every request in the run. Defaults to
+        WormNet.defaultTransport()
+
+        cache -- an optional WormCache.ResponseCache shared by every WormData in the run
+
+        window -- how far past the oldest unfinished gene the run may start new genes. Bounds
+        how many finished genes can be held waiting for an earlier one. Defaults to four times
+        the worker count, or the concurrency on the asyncio backend
+
+        journal -- an optional RunJournal. Genes it already holds are not fetched again, and
+        every gene this run completes is added to it
+
+        previous -- an optional WormCSV.PreviousOutputCSV. Genes that have a row in it are taken
+        from it instead of WormBase, so only new genes are fetched
+
+        fields -- the names (from WormCSV.WormData.FIELDS) of the fields to collect. Endpoints
+        that none of them need are never requested. Defaults to every field
+
+        strategy -- how gene endpoints are requested, one of WormCSV.WormData.STRATEGIES. Defaults
+        to WormCSV.WormData.DEFAULT_STRATEGY
+
+        stats -- an optional RunStats, which every WormData of the run reports its requests to
+        """
+        if backend not in self.BACKENDS:
+            raise ValueError('Unknown backend: ' + str(backend))
+        if backend == 'asyncio' and WormNet.loadAiohttp() is None:
+            backend = 'threads'
+
+        self.ids = ids
+        self.database = database
+        self.workers = workers or self.DEFAULT_WORKERS
+        self.backend = backend
+        self.concurrency = concurrency
+        self.transport = transport or WormNet.defaultTransport()
+        self.cache = cache
+        self.window = window
+        self.journal = journal
+        self.previous = previous
+        self.fields = list(fields or WormCSV.WormData.FIELDS)
+        self.strategy = strategy
+        self.stats = stats
+
+        # (geneID, failure) for every request that failed for good. See WormData.failures
+        self.failures = []
+        self.remaining = []
+
+        # Set by cancel(). Read by results() between genes
+        self.cancelled = False
+
+        # Every distinct request is made at most once per run. This matters most when
+        # several DB IDs map to the same gene, or gene models share proteins
+        self.coalescer = WormNet.Coalescer()
+
+        # The one thread pool every WormData of a threaded run makes its calls on,
+        # while results() is running. See resultsThreaded()
+        self.fetchExecutor = None
+
+    def resolve (self, id):
+        """Turns one input ID into the list of (dbId, geneID) pairs it stands for
+
+        XLOC IDs are looked up in the CuffLink database, where a single XLOC ID
+        can map to several comma-separated WormBase gene IDs. Anything else is
+        taken to be a WormBase gene ID already, and has no DB ID.
+        """
+        if self.database and id.startswith("XLOC"):
+            return [(id, geneID) for geneID in self.database.get(id)['gene'].split(',')]
+        else:
+            return [(None, id)]
+
+    def newWormData (self, dbId, geneID):
+        """Creates the (not yet populated) WormData object for a single gene"""
+        if dbId:
+            d = WormCSV.WormData(dbId, geneID, self.database, autoPopulate=False, transport=self.transport,
+                                 cache=self.cache, coalescer=self.coalescer, fields=self.fields,
+                                 strategy=self.strategy, stats=self.stats, executor=self.fetchExecutor)
+            d.data['db_id'] = dbId
+        else:
+            d = WormCSV.WormData(None, geneID, None, autoPopulate=False, transport=self.transport,
+                                 cache=self.cache, coalescer=self.coalescer, fields=self.fields,
+                                 strategy=self.strategy, stats=self.stats, executor=self.fetchExecutor)
+        return d
+
+    def restore (self, dbId, geneID):
+        """Returns the WormData for a gene from the journal or the previous output, or None if neither has it
+
+        Genes taken from the previous output are added to the journal, since the
+        previous output may be the very file this run is overwriting. The saved
+        up/down value is not trusted: it is read again from this run's CuffLink
+        database, which may not be the one the row was written with.
+        """
+        saved = None
+        if self.journal:
+            saved = self.journal.get(dbId, geneID)
+            source = self.journal
+
+        fromPrevious = False
+        if saved is None and self.previous:
+            saved = self.previous.get(dbId, geneID)
+            source = self.previous
+            fromPrevious = saved is not None
+
+        if saved is None:
+            return None
+
+        d = self.newWormData(dbId, geneID)
+        d.data = saved
+        d.lists = source.getLists(dbId, geneID)
+        d.data.pop('up/down', None)
+        d.collectFoldChange()
+        if fromPrevious and self.journal:
+            self.journal.record(d)
+        return d
+
+    def collect (self, dbId, geneID):
+        """Creates and populates the WormData object for a single gene
+
+        Genes already completed by an earlier attempt at this run are taken from
+        the journal instead of WormBase. Newly completed genes are added to it.
+        """
+        d = self.restore(dbId, geneID)
+        if d is None:
+            d = self.newWormData(dbId, geneID)
+            d.populate()
+            self.completed(d)
+        elif self.stats:
+            self.stats.recordGene(restored=True)
+        return d
+
+    def completed (self, d):
+        """Records a freshly populated WormData in the run's failures and journal
+
+        A gene with failed requests is left out of the journal, so that resuming
+        the run tries it again.
+        """
+        for failure in d.failures:
+            self.failures.append((d.geneID, failure))
+
+        if self.stats:
+            self.stats.recordGene()
+
+        if self.journal and not d.failures:
+            self.journal.record(d)
+
+    def jobs (self):
+        """Returns the list of (index, dbId, geneID) genes to collect, where index is the position of the input ID"""
+        jobs = []
+        for index, id in enumerate(self.ids):
+            for dbId, geneID in self.resolve(id):
+                jobs.append((index, dbId, geneID))
+        return jobs
+
+    def headers (self):
+        """Returns the columns of the output CSV for this run: the ID columns, then the chosen fields in HEADERS order"""
+        return [h for h in self.HEADERS if h in self.ID_HEADERS or h in self.fields]
+
+    def hasDbIds (self):
+        """Identifies whether any row of the output will carry a DB ID
+
+        Only XLOC IDs looked up in the database get a DB ID (and an up/down value),
+        so this is known before anything is fetched. The output uses it to decide
+        whether the 'db_id' and 'up/down' columns are needed.
+        """
+        if not self.database:
+            return False
+
+        for id in self.ids:
+            if id.startswith("XLOC"):
+                return True
+        return False
+
+    def pause (self):
+        """Holds back every request not yet sent, until resume() is called. Safe to call from any thread
+
+        Requests already in flight finish and their results are kept, and the
+        transport's connections stay open, so resuming fetches nothing twice.
+        """
+        self.transport.limiter.pause()
+
+    def resume (self):
+        """Carries on a run held back by pause(). Safe to call from any thread"""
+        self.transport.limiter.resume()
+
+    def cancel (self):
+        """Stops the run. Safe to call from any thread
+
+        No new genes are started, and every request not yet sent fails at once
+        with WormNet.RunCancelled, so genes already started wind down quickly.
+        results() stops after the last gene that was finished in order before
+        the cancel. Genes finished out of order are still in the journal, if
+        there is one, so they are not fetched again when the run is resumed.
+        """
+        self.cancelled = True
+        self.transport.limiter.close()
+
+    def jobFinished (self, index, onFinished):
+        """Records that one gene of input ID number `index` is done, and reports the ID once all of its genes are"""
+        self.remaining[index] -= 1
+        if self.remaining[index] == 0 and onFinished:
+            onFinished(self.ids[index])
+
+    def run (self, onFinished=None):
+        """Collects the data for every ID in the run and returns it all at once
+
+        Arguments:
+        onFinished -- optional callable, called with each input ID once all of its
+        genes have been collected
+
+        Return:
+        the list of populated WormData objects, in the same order as the input IDs
+        """
+        return list(self.results(onFinished))
+
+    def results (self, onFinished=None):
+        """Collects the data for every ID in the run, yielding each WormData as soon as it can be
+
+        Many genes are collected at the same time, so they will often finish out
+        of order. A finished gene is held back until every gene before it has been
+        yielded, so the WormData objects always come out in input order. Nothing is
+        kept once it has been yielded, and no gene more than self.window places
+        past the oldest one still outstanding is started, so memory stays bounded
+        no matter how long the run is.
+
+        Arguments:
+        onFinished -- optional callable, called with each input ID once all of its
+        genes have been collected
+
+        Return:
+        a generator of populated WormData objects, in the same order as the input IDs
+        """
+        jobs = self.jobs()
+
+        # Count the genes still outstanding for each input ID, so that we
+        # can report an ID as soon as the last of its genes comes back
+        self.remaining = [0] * len(self.ids)
+        for index, dbId, geneID in jobs:
+            self.remaining[index] += 1
+        if self.stats:
+            self.stats.expect(len(jobs))
+
+        # The transport (and so its limiter) may have been paused or closed by an earlier run
+        if not self.cancelled:
+            self.transport.limiter.open()
+
+        if self.backend == 'asyncio':
+            return self.resultsAsync(jobs, onFinished)
+        else:
+            return self.resultsThreaded(jobs, onFinished)
+
+    def resultsThreaded (self, jobs, onFinished):
+        """The 'threads' backend of results(). Up to self.workers genes are collected at once
+
+        Each gene's calls are made on a single pool shared by the whole run, with
+        enough threads for every worker to have MAX_FETCH_WORKERS calls in flight,
+        rather than on a pool started and stopped for every gene.
+        """
+        window = self.window or self.workers * 4
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.fetchExecutor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers * WormCSV.WormData.MAX_FETCH_WORKERS)
+        futures = []
+        pending = set()
+        indexOf = {}
+        cursor = 0
+        try:
+            while cursor < len(jobs) and not self.cancelled:
+                while len(futures) < len(jobs) and len(futures) < cursor + window:
+                    index, dbId, geneID = jobs[len(futures)]
+                    future = executor.submit(self.collect, dbId, geneID)
+                    indexOf[future] = index
+                    futures.append(future)
+                    pending.add(future)
+
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    self.jobFinished(indexOf.pop(future), onFinished)
+
+                while cursor < len(futures) and futures[cursor].done() and not self.cancelled:
+                    d = futures[cursor].result()
+                    futures[cursor] = None
+                    cursor += 1
+                    yield d
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.fetchExecutor.shutdown(wait=True)
+            self.fetchExecutor = None
+
+    def resultsAsync (self, jobs, onFinished):
+        """The 'asyncio' backend of results()
+
+        The event loop only runs while we wait for the next gene in order, which
+        is almost all of the time. The AsyncFetcher's concurrency limit is what
+        keeps the number of requests in flight in check.
+        """
+        import asyncio
+        loop = asyncio.new_event_loop()
+        fetcher = WormNet.AsyncFetcher(self.concurrency, self.transport)
+        window = self.window or fetcher.concurrency
+        tasks = []
+        loop.run_until_complete(fetcher.__aenter__())
+        try:
+            for cursor in range(len(jobs)):
+                while len(tasks) < len(jobs) and len(tasks) < cursor + window:
+                    index, dbId, geneID = jobs[len(tasks)]
+                    tasks.append(loop.create_task(self.collectAsync(fetcher, index, dbId, geneID, onFinished)))
+
+                d = loop.run_until_complete(tasks[cursor])
+                tasks[cursor] = None
+                # A gene that finished after the cancel may be missing data its
+                # requests never fetched, so it is not yielded
+                if self.cancelled:
+                    break
+                yield d
+        finally:
+            loop.run_until_complete(self.cancelAsync())
+            loop.run_until_complete(fetcher.__aexit__(None, None, None))
+            loop.close()
+
+    async def cancelAsync (self):
+        """Coroutine that cancels every other task on the event loop and waits for them to wind down
+
+        This catches the requests started on behalf of a gene (and the coalesced
+        requests shared between genes), not just the genes themselves.
+        """
+        import asyncio
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def collectAsync (self, fetcher, index, dbId, geneID, onFinished):
+        """Coroutine that creates and populates the WormData object for a single gene. See collect()"""
+        d = self.restore(dbId, geneID)
+        if d is None:
+            d = self.newWormData(dbId, geneID)
+            await d.populateAsync(fetcher)
+            self.completed(d)
+        elif self.stats:
+            self.stats.recordGene(restored=True)
+        self.jobFinished(index, onFinished)
+        return d
+
+
+class RunJournal ():
+    """A record of every gene completed so far in a run, kept on disk
+
+    Each completed WormData is appended to the journal file as a line of JSON
+    and flushed straight away. If the run dies, starting the same run again
+    with the same journal skips every gene recorded in it. A journal only
+    belongs to one list of IDs, one choice of fields and one version of the
+    CuffLink database: if it is opened for a different run, the old contents
+    are thrown away and it starts over.
+
+    Only the genes read back by load() are held in memory. Genes recorded
+    during this run are written to the file and nowhere else, so a long run
+    doesn't keep every row it has written.
+    """
+
+    def __init__ (self, path, ids, fields=None, databasePath=None):
+        """Opens the journal at `path` for a run over `ids`, loading what an earlier attempt completed
+
+        Arguments:
+        path -- the journal file. Usually the output path with '.journal' added
+        ids -- the scrubbed list of input IDs of the run
+        fields -- the fields the run collects. None (every field) gives the same
+        signature as a journal written before fields could be chosen
+        databasePath -- the CuffLink database file the run reads fold changes from, if any.
+        Switching to another file, or changing this one, starts the journal over, since
+        the saved rows carry its up/down values
+        """
+        self.path = path
+        signed = '\n'.join(ids)
+        if fields is not None:
+            # The order fields were chosen in doesn't change what the run collects
+            fields = [field for field in WormCSV.WormData.FIELDS if field in fields]
+        if fields is not None and fields != WormCSV.WormData.FIELDS:
+            signed += '\nfields:' + ','.join(fields)
+        if databasePath:
+            stat = os.stat(databasePath)
+            signed += '\ndatabase:%s:%d:%d' % (os.path.abspath(databasePath), stat.st_size, stat.st_mtime_ns)
+        self.signature = hashlib.sha1(signed.encode()).hexdigest()
+        self.completed = {}
+        self.lock = threading.Lock()
+
+        if self.load():
+            self.file = open(path, 'a')
+        else:
+            self.file = open(path, 'w')
+            self.file.write(json.dumps({'signature': self.signature}) + '\n')
+            self.file.flush()
+
+    def load (self):
+        """Reads the existing journal, if it belongs to this run. Returns True if it did"""
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, 'r') as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                return False
+            if header.get('signature') != self.signature:
+                return False
+
+            # A run killed mid-write can leave a partial last line. It is
+            # simply skipped, and that gene is fetched again
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.completed[(entry['db_id'], entry['gene_id'])] = entry
+        return True
+
+    def get (self, dbId, geneID):
+        """Returns the saved data of a completed gene, or None if it hasn't been completed"""
+        entry = self.completed.get((dbId, geneID))
+        if entry is None:
+            return None
+        return dict(entry['data'])
+
+    def getLists (self, dbId, geneID):
+        """Returns the saved values of each list field of a completed gene. See WormData.lists"""
+        entry = self.completed.get((dbId, geneID))
+        if entry is None:
+            return {}
+        return dict(entry.get('lists', {}))
+
+    def record (self, wormData):
+        """Appends a completed WormData to the journal file. It is not kept in self.completed"""
+        line = json.dumps({'db_id': wormData.dbId, 'gene_id': wormData.geneID, 'data': wormData.describe(),
+                           'lists': wormData.lists})
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close (self):
+        """Closes the journal, keeping it so the run can be resumed"""
+        self.file.close()
+
+    def remove (self):
+        """Closes and deletes the journal. Call once the run has completed"""
+        self.file.close()
+        os.remove(self.path)
+
+
+class RunStats ():
+    """Counters and timings for the WormBase requests made during a run
+
+    Every WormData of the run reports each request it makes (or answers from
+    the cache) here, under the name of its endpoint, e.g. 'gene/gene_models',
+    'widget/overview' or 'protein/best_human_match'. A request that another
+    gene already made is shared through the coalescer and is only counted once.
+    The latency of a request covers every retry, and any wait for the limiter.
+
+    At the end of a run, lines() gives a summary for the console and write()
+    saves the whole report as JSON.
+    """
+
+    LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+    """The upper bounds (in seconds) of the latency histogram buckets. Anything slower goes in a last, open bucket"""
+
+    def __init__ (self):
+        """Constructs an empty RunStats. The run is timed from here until finish() is called"""
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.genes = 0
+        self.restored = 0
+        self.expected = None
+        self.started = time.time()
+        self.finished = None
+
+    def record (self, endpoint, latency, size=0, error=False, empty=False, cached=False):
+        """Counts one request. Safe to call from any thread
+
+        Arguments:
+        endpoint -- the name of the endpoint, e.g. 'gene/concise_description'
+        latency -- seconds the request took
+        size -- bytes in the body of the response. 0 for cache hits and errors
+        error -- True if the request failed for good
+        empty -- True if the response held no data
+        cached -- True if the response came from the cache instead of WormBase
+        """
+        with self.lock:
+            e = self.endpoints.get(endpoint)
+            if e is None:
+                e = self.endpoints[endpoint] = {'requests': 0, 'network': 0, 'cacheHits': 0, 'errors': 0,
+                                                'empty': 0, 'bytes': 0, 'seconds': 0.0, 'maxSeconds': 0.0,
+                                                'histogram': [0] * (len(self.LATENCY_BUCKETS) + 1)}
+            e['requests'] += 1
+            if cached:
+                e['cacheHits'] += 1
+            else:
+                e['network'] += 1
+            if error:
+                e['errors'] += 1
+            if empty:
+                e['empty'] += 1
+            e['bytes'] += size
+            e['seconds'] += latency
+            e['maxSeconds'] = max(e['maxSeconds'], latency)
+            e['histogram'][bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+
+    def recordGene (self, restored=False):
+        """Counts one finished gene. restored is True if it came from the journal or a previous output"""
+        with self.lock:
+            self.genes += 1
+            if restored:
+                self.restored += 1
+
+    def expect (self, genes):
+        """Sets the number of genes the run will collect in all. Called by WormBaitRun.results()"""
+        self.expected = genes
+
+    def progress (self):
+        """Returns the counts so far, cheaply enough to call several times a second while the run goes on
+
+        Return:
+        a dict with 'seconds' (since the run started), 'genes', 'restoredGenes', 'expectedGenes'
+        (None until the run knows), and the request totals 'requests', 'network', 'cacheHits'
+        and 'errors'
+        """
+        progress = {'requests': 0, 'network': 0, 'cacheHits': 0, 'errors': 0}
+        with self.lock:
+            for e in self.endpoints.values():
+                for total in progress:
+                    progress[total] += e[total]
+            progress['genes'] = self.genes
+            progress['restoredGenes'] = self.restored
+        progress['expectedGenes'] = self.expected
+        progress['seconds'] = (self.finished or time.time()) - self.started
+        return progress
+
+    def finish (self):
+        """Stops the clock on the run"""
+        self.finished = time.time()
+
+    def percentile (self, e, p):
+        """Estimates a latency percentile of an endpoint from its histogram
+
+        Return:
+        the upper bound (in seconds) of the bucket holding the p-th percentile, or the
+        slowest latency seen if that is the last, open bucket
+        """
+        target = p * e['requests']
+        seen = 0
+        for bound, count in zip(self.LATENCY_BUCKETS, e['histogram']):
+            seen += count
+            if seen >= target:
+                return min(bound, e['maxSeconds'])
+        return e['maxSeconds']
+
+    def summary (self):
+        """Returns the whole report as a dict, ready to be written as JSON"""
+        seconds = (self.finished or time.time()) - self.started
+        endpoints = {}
+        with self.lock:
+            for name, e in sorted(self.endpoints.items()):
+                histogram = {}
+                lower = 0
+                for bound, count in zip(self.LATENCY_BUCKETS + [None], e['histogram']):
+                    label = '>%d' % (lower * 1000) if bound is None else '<=%d' % (bound * 1000)
+                    histogram[label] = count
+                    lower = bound
+
+                endpoints[name] = {'requests': e['requests'],
+                                   'network': e['network'],
+                                   'cacheHits': e['cacheHits'],
+                                   'errors': e['errors'],
+                                   'empty': e['empty'],
+                                   'bytes': e['bytes'],
+                                   'meanMs': round(e['seconds'] / e['requests'] * 1000, 2),
+                                   'p50Ms': round(self.percentile(e, 0.5) * 1000, 2),
+                                   'p95Ms': round(self.percentile(e, 0.95) * 1000, 2),
+                                   'maxMs': round(e['maxSeconds'] * 1000, 2),
+                                   'latencyHistogramMs': histogram}
+
+            genes, restored = self.genes, self.restored
+
+        report = {'seconds': round(seconds, 3),
+                  'genes': genes,
+                  'restoredGenes': restored,
+                  'genesPerSecond': round(genes / seconds, 2) if seconds else None,
+                  'endpoints': endpoints}
+        for total in ['requests', 'network', 'cacheHits', 'errors', 'empty', 'bytes']:
+            report[total] = sum(e[total] for e in endpoints.values())
+        return report
+
+    def lines (self):
+        """Returns the report as lines of text, one per endpoint plus totals, for the console"""
+        report = self.summary()
+        lines = ['%-28s %8s %7s %6s %6s %9s %8s %8s' % ('endpoint', 'requests', 'cached', 'errors', 'empty',
+                                                         'KB', 'mean ms', 'p95 ms')]
+        for name, e in report['endpoints'].items():
+            lines.append('%-28s %8d %7d %6d %6d %9.1f %8.1f %8.1f' % (name, e['requests'], e['cacheHits'], e['errors'],
+                                                                     e['empty'], e['bytes'] / 1024.0, e['meanMs'],
+                                                                     e['p95Ms']))
+        lines.append('%d genes (%d reused) in %.1f s; %d requests, %d from the cache, %d failed, %d empty, %.1f KB' %
+                     (report['genes'], report['restoredGenes'], report['seconds'], report['requests'],
+                      report['cacheHits'], report['errors'], report['empty'], report['bytes'] / 1024.0))
+        return lines
+
+    def write (self, path, extra=None):
+        """Writes the report to `path` as JSON, with anything in the dict `extra` added at the top level"""
+        report = self.summary()
+        report.update(extra or {})
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+class RunProfiler ():
+    """Profiles a whole run, including the threads it starts
+
+    Before Python 3.12, cProfile only sees the thread that enabled it, but most
+    of a threaded run happens on worker threads. So while the profiler is
+    running, every new thread gets a profile of its own, and they are all merged
+    when the results are saved; threads that were already running when the
+    profiler started are not profiled. From 3.12 on, a single profile sees every
+    thread, and only one may be enabled at a time, so just the one is used.
+    """
+
+    DEFAULT_TOP = 40
+    """How many functions are listed in each table of the text summary"""
+
+    PROFILES_ALL_THREADS = sys.version_info >= (3, 12)
+    """Whether one cProfile.Profile covers every thread (and is the only one allowed)"""
+
+    def __init__ (self):
+        """Constructs a RunProfiler. Nothing is profiled until start() is called"""
+        self.lock = threading.Lock()
+        self.profiles = []
+
+    def start (self):
+        """Starts profiling the current thread, and every thread started from now on"""
+        import cProfile
+        profile = cProfile.Profile()
+        self.profiles.append(profile)
+        if not self.PROFILES_ALL_THREADS:
+            threading.setprofile(self.startThread)
+        profile.enable()
+
+    def startThread (self, frame, event, arg):
+        """Installed with threading.setprofile(). Switches each new thread over to a profile of its own"""
+        import cProfile
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def stop (self):
+        """Stops profiling. Threads started earlier keep their profiles until save() is called"""
+        if not self.PROFILES_ALL_THREADS:
+            threading.setprofile(None)
+        self.profiles[0].disable()
+
+    def save (self, path, top=None):
+        """Writes the merged profile to `path` + '.prof' and a text summary to `path` + '.profile.txt'
+
+        The .prof file can be loaded with pstats or a viewer such as snakeviz. The
+        summary lists the functions with the most cumulative time, then those with
+        the most time of their own.
+
+        Arguments:
+        path -- the path the two files are named after, usually the output CSV
+        top -- how many functions to list in each table. Defaults to DEFAULT_TOP
+
+        Return:
+        the paths of the two files written
+        """
+        import io
+        import pstats
+        with self.lock:
+            profiles = list(self.profiles)
+
+        stream = io.StringIO()
+        stats = pstats.Stats(profiles[0], stream=stream)
+        for profile in profiles[1:]:
+            stats.add(profile)
+
+        if self.PROFILES_ALL_THREADS:
+            stream.write('Profile of a WormBait run\n\n')
+        else:
+            stream.write('Profile of a WormBait run over %d threads\n\n' % len(profiles))
+        stats.sort_stats('cumulative').print_stats(top or self.DEFAULT_TOP)
+        stats.sort_stats('tottime').print_stats(top or self.DEFAULT_TOP)
+
+        stats.dump_stats(path + '.prof')
+        with open(path + '.profile.txt', 'w') as f:
+            f.write(stream.getvalue())
+        return path + '.prof', path + '.profile.txt'
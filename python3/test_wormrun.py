@@ -0,0 +1,182 @@
+import unittest
+import csv
+import tempfile
+import os
+import WormCSV
+import WormRun
+import WormNet
+import WormMock
+
+"""Tests of WormBaitRun against a MockWormBase
+
+Each test points WormData at a mock server on a thread of this process and
+performs a real run over it, so that the ordering, the sharing of requests,
+the journal and the incremental merge are all exercised as they are against
+WormBase. Run from this directory with:
+
+    python3 -m unittest test_wormrun
+"""
+
+class TestWormBaitRun (unittest.TestCase):
+    """Whole runs of WormBait over the mock, on each backend that is available"""
+
+    BASES = ['GENE_BASE', 'PROTEIN_BASE', 'WIDGET_BASE']
+    """The WormData attributes that name the API, pointed at the mock for the duration of the tests"""
+
+    SHARED_PROTEIN = {'gene_models': {'table': [{'protein': {'id': 'CE_SHARED'}}]}}
+    """Fixtures under which every gene has the same single protein"""
+
+    @classmethod
+    def setUpClass (cls):
+        cls.saved = dict((name, getattr(WormCSV.WormData, name)) for name in cls.BASES)
+        cls.backends = ['threads']
+        if WormNet.loadAiohttp() is not None:
+            cls.backends.append('asyncio')
+
+    @classmethod
+    def tearDownClass (cls):
+        for name, value in cls.saved.items():
+            setattr(WormCSV.WormData, name, value)
+
+    def setUp (self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.mocks = []
+
+    def tearDown (self):
+        for mock in self.mocks:
+            mock.stop()
+        self.directory.cleanup()
+
+    def startMock (self, **settings):
+        """Starts a MockWormBase with `settings` and points WormData at it"""
+        mock = WormMock.MockWormBase(**settings)
+        root = mock.start()
+        self.mocks.append(mock)
+        WormCSV.WormData.GENE_BASE = root + '/rest/field/gene'
+        WormCSV.WormData.PROTEIN_BASE = root + '/rest/field/protein'
+        WormCSV.WormData.WIDGET_BASE = root + '/rest/widget/gene'
+        return mock
+
+    def path (self, name):
+        """Returns the path of a file called `name` in this test's directory"""
+        return os.path.join(self.directory.name, name)
+
+    def perform (self, ids, backend, journal=None, previous=None, cancelAfter=None, outputPath=None):
+        """Runs WormBait over `ids`, writing the output to `outputPath` if given
+
+        Arguments:
+        cancelAfter -- cancel the run once this many rows have been written
+
+        Return:
+        the WormBaitRun, and the gene ID of every row written, in order
+        """
+        transport = WormNet.Transport()
+        run = WormRun.WormBaitRun(ids, None, 4, backend, 8, transport, journal=journal, previous=previous)
+        output = None
+        if outputPath:
+            output = WormCSV.openOutput(outputPath, run.headers(), staged=previous is not None)
+            output.start(run.hasDbIds())
+
+        written = []
+        complete = False
+        try:
+            for wormData in run.results():
+                written.append(wormData.geneID)
+                if output:
+                    output.writeRow(wormData)
+                if cancelAfter is not None and len(written) >= cancelAfter:
+                    run.cancel()
+            complete = not run.cancelled
+        finally:
+            if output:
+                output.finish(complete)
+            transport.close()
+        return run, written
+
+    def readOutput (self, path):
+        """Returns the gene ID of every row of the output CSV at `path`, in order"""
+        with open(path, 'r') as f:
+            return [row['gene_id'] for row in csv.DictReader(f)]
+
+    def testOutputOrder (self):
+        """Genes finish out of order, but come out in input order"""
+        self.startMock(latency=0.01, jitter=0.01)
+        ids = ['WBGene%08d' % i for i in range(60, 0, -1)]
+        for backend in self.backends:
+            run, written = self.perform(ids, backend)
+            self.assertEqual(written, ids, backend)
+            self.assertEqual(run.failures, [], backend)
+
+    def testOneRequestPerKey (self):
+        """A gene listed twice, and a protein shared by every gene, are each requested once"""
+        for backend in self.backends:
+            mock = self.startMock(latency=0.005, fixtures=self.SHARED_PROTEIN)
+            ids = ['WBGene%08d' % i for i in range(1, 21)]
+            self.perform(ids, backend)
+            once = mock.stats()
+
+            mock.reset()
+            run, written = self.perform(ids + ids, backend)
+            twice = mock.stats()
+            self.assertEqual(written, ids + ids, backend)
+            self.assertEqual(twice['byEndpoint'], once['byEndpoint'], backend)
+            self.assertEqual(twice['byEndpoint']['protein/best_human_match'], 1, backend)
+
+    def testCancelAndResume (self):
+        """A cancelled run keeps what it finished, and resuming it fetches only the rest"""
+        ids = ['WBGene%08d' % i for i in range(1, 41)]
+        for backend in self.backends:
+            mock = self.startMock(latency=0.01)
+            outputPath = self.path(backend + '.csv')
+            journal = WormRun.RunJournal(outputPath + '.journal', ids)
+            run, first = self.perform(ids, backend, journal=journal, cancelAfter=10, outputPath=outputPath)
+            journal.close()
+            self.assertTrue(run.cancelled, backend)
+            self.assertEqual(first, ids[:len(first)], backend)
+            self.assertEqual(self.readOutput(outputPath), first, backend)
+
+            journal = WormRun.RunJournal(outputPath + '.journal', ids)
+            kept = len(journal.completed)
+            self.assertGreaterEqual(kept, len(first), backend)
+
+            mock.reset()
+            run, second = self.perform(ids, backend, journal=journal, outputPath=outputPath)
+            journal.remove()
+            self.assertEqual(second, ids, backend)
+            self.assertEqual(self.readOutput(outputPath), ids, backend)
+            # Nothing in the journal was asked for again
+            genesFetched = mock.stats()['byEndpoint'].get('gene/gene_models', 0)
+            self.assertEqual(genesFetched, len(ids) - kept, backend)
+
+    def testCancelledIncrementalRunKeepsPreviousOutput (self):
+        """An incremental run that is cancelled leaves the output it was replacing as it was"""
+        old = ['WBGene%08d' % i for i in range(1, 31)]
+        new = ['WBGene%08d' % i for i in range(100, 111)]
+        for backend in self.backends:
+            mock = self.startMock(latency=0.01)
+            outputPath = self.path(backend + '-incremental.csv')
+            self.perform(old, backend, outputPath=outputPath)
+
+            ids = new + old
+            journal = WormRun.RunJournal(outputPath + '.journal', ids)
+            previous = WormCSV.openPreviousOutput(outputPath)
+            run, written = self.perform(ids, backend, journal=journal, previous=previous, cancelAfter=5,
+                                        outputPath=outputPath)
+            journal.close()
+            self.assertTrue(run.cancelled, backend)
+            self.assertEqual(self.readOutput(outputPath), old, backend)
+            self.assertFalse(os.path.exists(outputPath + WormCSV.OutputCSV.STAGING_SUFFIX), backend)
+
+            journal = WormRun.RunJournal(outputPath + '.journal', ids)
+            previous = WormCSV.openPreviousOutput(outputPath)
+            mock.reset()
+            run, written = self.perform(ids, backend, journal=journal, previous=previous, outputPath=outputPath)
+            journal.remove()
+            self.assertEqual(self.readOutput(outputPath), ids, backend)
+            # The old genes all came from the previous output
+            genesFetched = mock.stats()['byEndpoint'].get('gene/gene_models', 0)
+            self.assertLessEqual(genesFetched, len(new), backend)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,14 @@
 #!/usr/bin/python
 
 import tkinter
-import tkinter.filedialog
 import WormCSV
+import WormRun
+import WormNet
+import WormCache
+import WormDB
 from WormBaitUI import ConsoleBox
 from WormBaitUI import ProcessButton
+from WormBaitUI import ProgressPanel
 from WormBaitUI import AboutWindow
 from configparser import SafeConfigParser
 
@@ -16,6 +20,12 @@ Christopher Anna, 2/18/2016
 class WormbaitWindow(tkinter.Tk):
     """The top-level window of WormBait"""
     VERSION = "2.0"
+
+    CONSOLE_LINES = 5000
+    """The most lines of scrollback the output console keeps"""
+
+    CLOSE_POLL_INTERVAL = 100
+    """Milliseconds between checks, when closing, that a cancelled run has wound down"""
     
     def __init__(self, parent):
         tkinter.Tk.__init__(self, parent)
@@ -25,6 +35,9 @@ class WormbaitWindow(tkinter.Tk):
     def initialize(self):
         self.dbFilePath = tkinter.StringVar()
         self.outFilePath = tkinter.StringVar()
+        self.incremental = tkinter.BooleanVar()
+        self.profile = tkinter.BooleanVar()
+        self.fieldVars = dict((field, tkinter.BooleanVar()) for field in WormCSV.WormData.FIELDS)
         self.entryList = ConsoleBox(self, 10)
         self.protocol("WM_DELETE_WINDOW", self.saveIniAndDestroy)
         self.buildContent()
@@ -38,6 +51,18 @@ class WormbaitWindow(tkinter.Tk):
         aboutMenu = tkinter.Menu(menubar, tearoff=0)
         aboutMenu.add_command(label="About WormBait", command=self.showAboutWindow)
         menubar.add_cascade(label="About", menu=aboutMenu)
+
+        # Unticking a field drops its column and skips the WormBase calls it
+        # needs. best_human_ortholog is the expensive one: one call per protein
+        fieldsMenu = tkinter.Menu(menubar, tearoff=0)
+        for field in WormCSV.WormData.FIELDS:
+            fieldsMenu.add_checkbutton(label=field, variable=self.fieldVars[field])
+        menubar.add_cascade(label="Fields", menu=fieldsMenu)
+
+        # Profiling saves where the time went (<output>.prof and <output>.profile.txt)
+        runMenu = tkinter.Menu(menubar, tearoff=0)
+        runMenu.add_checkbutton(label="Profile runs", variable=self.profile)
+        menubar.add_cascade(label="Run", menu=runMenu)
        
         self.entryList.grid(column=0, row=0, columnspan=2, sticky='NSEW')
         
@@ -53,23 +78,49 @@ class WormbaitWindow(tkinter.Tk):
         outFileBrowseButton = tkinter.Button(self, text="Browse...", command=self.OnOutBrowseButtonClick)
         outFileBrowseButton.grid(column=1, row=2)
 
+        # Pause and Cancel act on the run the Process button started
+        runButtons = tkinter.Frame(self)
+        runButtons.grid(column=0, row=3)
+
         self.button = ProcessButton(self)
         self.button.bind("<Return>", self.button.OnClick)
-        self.button.grid(column=0,row=3)
+        self.button.pack(in_=runButtons, side=tkinter.LEFT)
+
+        pauseButton = tkinter.Button(self, textvariable=self.button.pauseText, command=self.button.OnPauseClick)
+        pauseButton.pack(in_=runButtons, side=tkinter.LEFT)
+
+        cancelButton = tkinter.Button(self, text="Cancel", command=self.button.OnCancelClick)
+        cancelButton.pack(in_=runButtons, side=tkinter.LEFT)
+
+        incrementalCheck = tkinter.Checkbutton(self, text="Only fetch IDs missing from output", variable=self.incremental)
+        incrementalCheck.grid(column=1, row=3)
+
+        self.progress = ProgressPanel(self)
+        self.progress.grid(column=0, row=4, columnspan=2, sticky='EW')
         
-        self.console = ConsoleBox(self, 30)
-        self.console.grid(column=0,row=4, columnspan=2, sticky='NSEW')
+        self.console = ConsoleBox(self, 30, self.CONSOLE_LINES)
+        self.console.grid(column=0,row=5, columnspan=2, sticky='NSEW')
 
         self.grid_columnconfigure(0, weight=1)
         self.grid_rowconfigure(0, weight=1)
-        self.grid_rowconfigure(4, weight=1)
+        self.grid_rowconfigure(5, weight=1)
         self.resizable(True,False)
         self.update()
         self.config(menu=menubar)     
         self.entryList.focus_set()
 
     def saveIniAndDestroy (self):
-        """Writes current information to the ini file (wormBait.ini) and closes the user interface"""
+        """Writes current information to the ini file (wormBait.ini) and closes the user interface
+
+        A run still in progress is cancelled first. The window waits (without
+        blocking the main loop) until it has written its rows and closed its
+        journal, since it shares the response cache that is closed here.
+        """
+        if self.button.running():
+            self.button.OnCancelClick()
+            self.after(self.CLOSE_POLL_INTERVAL, self.saveIniAndDestroy)
+            return
+
         config = SafeConfigParser()
         config.read('wormBait.ini')
 
@@ -83,6 +134,27 @@ class WormbaitWindow(tkinter.Tk):
         config.set('wormBait', 'dbIds', dbIds)
         config.set('wormBait', 'degFile', self.dbFilePath.get())
         config.set('wormBait', 'outFile', self.outFilePath.get())
+        config.set('wormBait', 'workers', str(self.workers))
+        config.set('wormBait', 'backend', self.backend)
+        config.set('wormBait', 'concurrency', str(self.concurrency))
+        config.set('wormBait', 'strategy', self.strategy)
+        config.set('wormBait', 'poolSize', str(self.transport.poolSize))
+        config.set('wormBait', 'perHost', str(self.transport.perHost))
+        config.set('wormBait', 'connectTimeout', str(self.transport.connectTimeout))
+        config.set('wormBait', 'readTimeout', str(self.transport.readTimeout))
+        config.set('wormBait', 'attempts', str(self.transport.retry.attempts))
+        config.set('wormBait', 'deadline', str(self.transport.retry.deadline))
+        config.set('wormBait', 'hedge', str(self.transport.retry.hedge))
+        config.set('wormBait', 'cacheFile', self.cache.path)
+        config.set('wormBait', 'cacheTtlDays', str(self.cache.ttl / (24 * 60 * 60)))
+        config.set('wormBait', 'cacheMaxMB', str(self.cache.maxBytes // (1024 * 1024)))
+        config.set('wormBait', 'cacheMode', self.cache.mode)
+        config.set('wormBait', 'incremental', str(self.incremental.get()))
+        config.set('wormBait', 'fields', ','.join(self.selectedFields()))
+        config.set('wormBait', 'profile', str(self.profile.get()))
+        if self.maxAge is not None:
+            config.set('wormBait', 'maxAgeDays', str(self.maxAge / (24 * 60 * 60)))
+        self.cache.close()
 
         with open('wormBait.ini', 'w') as f:
             config.write(f)
@@ -103,6 +175,56 @@ class WormbaitWindow(tkinter.Tk):
             configDegFile = config.get('wormBait', 'degFile')
             configOutFile = config.get('wormBait', 'outFile')
 
+        # How the run is performed. These are not exposed in the UI, but can be
+        # tuned by editing wormBait.ini. 'workers' is the number of genes collected at
+        # once by the threads backend; 'concurrency' is the number of requests in flight
+        # at once on the asyncio backend
+        self.workers = config.getint('wormBait', 'workers', fallback=WormRun.WormBaitRun.DEFAULT_WORKERS)
+        self.backend = config.get('wormBait', 'backend', fallback='threads')
+        self.concurrency = config.getint('wormBait', 'concurrency', fallback=WormNet.AsyncFetcher.DEFAULT_CONCURRENCY)
+
+        # 'widgets' collects several gene fields with one WormBase call where it can;
+        # 'fields' makes one call per field, as WormBait always used to
+        self.strategy = config.get('wormBait', 'strategy', fallback=WormCSV.WormData.DEFAULT_STRATEGY)
+
+        # One transport is kept for the life of the window, so connections to
+        # WormBase stay open from one run to the next
+        # Failed requests are tried up to 'attempts' times in all, within 'deadline' seconds.
+        # 'hedge' sends a duplicate of any request slower than 95% of recent ones
+        retry = WormNet.RetryPolicy(config.getint('wormBait', 'attempts', fallback=None),
+                                    deadline=config.getfloat('wormBait', 'deadline', fallback=None),
+                                    hedge=config.getboolean('wormBait', 'hedge', fallback=False))
+        self.transport = WormNet.Transport(config.getint('wormBait', 'poolSize', fallback=None),
+                                           config.getint('wormBait', 'perHost', fallback=None),
+                                           config.getfloat('wormBait', 'connectTimeout', fallback=None),
+                                           config.getfloat('wormBait', 'readTimeout', fallback=None),
+                                           retry=retry)
+
+        # WormBase responses are cached on disk between runs. Set cacheMode to
+        # 'refresh' to re-download everything, or 'bypass' to ignore the cache entirely
+        cacheTtlDays = config.getfloat('wormBait', 'cacheTtlDays', fallback=None)
+        cacheMaxMB = config.getint('wormBait', 'cacheMaxMB', fallback=None)
+        self.cache = WormCache.ResponseCache(config.get('wormBait', 'cacheFile', fallback='wormBaitCache.sqlite'),
+                                             None if cacheTtlDays is None else cacheTtlDays * 24 * 60 * 60,
+                                             None if cacheMaxMB is None else cacheMaxMB * 1024 * 1024,
+                                             config.get('wormBait', 'cacheMode', fallback='use'))
+
+        # Incremental runs reuse rows from the existing output file, as long as it
+        # is no older than maxAgeDays (no limit if not set)
+        self.incremental.set(config.getboolean('wormBait', 'incremental', fallback=False))
+        maxAgeDays = config.getfloat('wormBait', 'maxAgeDays', fallback=None)
+        self.maxAge = None if maxAgeDays is None else maxAgeDays * 24 * 60 * 60
+
+        # The fields collected by a run, as a comma-separated list. Every field if not set
+        try:
+            fields = WormRun.parse_fields(config.get('wormBait', 'fields', fallback=''))
+        except ValueError:
+            fields = WormCSV.WormData.FIELDS
+        for field, var in self.fieldVars.items():
+            var.set(field in fields)
+
+        self.profile.set(config.getboolean('wormBait', 'profile', fallback=False))
+
         if configDbIds:
             self.entryList.writeln(configDbIds)
         else:
@@ -118,14 +240,23 @@ class WormbaitWindow(tkinter.Tk):
         else:
             self.outFilePath.set('Enter desired path to output CSV file here')
 
+    def selectedFields (self):
+        """Returns the fields ticked in the Fields menu, in WormData.FIELDS order. Every field if none are ticked"""
+        fields = [field for field in WormCSV.WormData.FIELDS if self.fieldVars[field].get()]
+        return fields or list(WormCSV.WormData.FIELDS)
+
     def OnDBBrowseButtonClick (self, *ignore):
         """Opens a browser for selecting the database file"""
+        import tkinter.filedialog
         dialogReturn = tkinter.filedialog.askopenfilename(filetypes=[('Comma-separated value', '*.csv')])
         self.dbFilePath.set(dialogReturn)
 
     def OnOutBrowseButtonClick (self, *ignore):
-        """Opens a browser for selecting the CSV output file location"""
-        dialogReturn = tkinter.filedialog.asksaveasfilename(filetypes=[('Comma-separated value', '*.csv')])
+        """Opens a browser for selecting the output file location, a CSV or a SQLite database"""
+        import tkinter.filedialog
+        sqlitePatterns = ' '.join('*' + suffix for suffix in WormDB.SUFFIXES)
+        dialogReturn = tkinter.filedialog.asksaveasfilename(filetypes=[('Comma-separated value', '*.csv'),
+                                                                       ('SQLite database', sqlitePatterns)])
         self.outFilePath.set(dialogReturn)
 
     def showAboutWindow (self):
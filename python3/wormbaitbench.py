@@ -0,0 +1,241 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import WormCSV
+import WormRun
+import WormNet
+import WormMock
+
+"""This script benchmarks WormBait runs against a local mock of the WormBase API.
+
+For each run size it starts a fresh run over that many made-up WBGene IDs, the
+same way the Process button does (minus the window): the genes are collected by
+a WormBaitRun and streamed into an output CSV. No response cache or journal is
+used, so every request goes to the mock server. The results (genes per second,
+request counts and latency percentiles, both as served by the mock and as seen
+by WormBait) are printed and written to a JSON report,
+so that one version of WormBait can be compared with another.
+
+With --startup, it instead times how long the WormBait modules take to import
+in a fresh interpreter, which is most of the time WormBait takes to start. It
+also checks that none of the modules WormBait only imports once it is needed
+(see DEFERRED_MODULES) have crept back into startup, and exits with status 1 if
+any have, or if startup is slower than --max-startup-ms.
+
+Example:
+    ./wormbaitbench.py --sizes 100,1000 --latency 20 --error-rate 0.01 --report bench.json
+    ./wormbaitbench.py --startup --max-startup-ms 300
+"""
+
+STARTUP_MODULES = ['wormbait', 'wormbaitcli']
+"""The entry points whose startup is timed by --startup"""
+
+DEFERRED_MODULES = ['requests', 'asyncio', 'aiohttp', 'cProfile', 'pstats', 'tkinter.filedialog', 'email.utils']
+"""Modules that WormBait imports only when first needed. Importing an entry point must not import any of them"""
+
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import %s
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'deferred': [m for m in %r if m in sys.modules]}))
+"""
+"""Run by a fresh interpreter for each startup measurement. Prints the import time and any deferred modules loaded"""
+
+def parseArguments (argv):
+    """Builds the command line parser and parses argv"""
+    parser = argparse.ArgumentParser(description='Benchmark WormBait runs against a local mock of the WormBase API.')
+    parser.add_argument('--sizes', default='100,1000,10000', help='comma-separated numbers of genes to run')
+    parser.add_argument('--report', default='wormBaitBench.json', help='the JSON report to write')
+    parser.add_argument('--backend', choices=WormRun.WormBaitRun.BACKENDS, default='threads')
+    parser.add_argument('--workers', type=int, default=WormRun.WormBaitRun.DEFAULT_WORKERS)
+    parser.add_argument('--concurrency', type=int, default=WormNet.AsyncFetcher.DEFAULT_CONCURRENCY)
+    parser.add_argument('--strategy', choices=WormCSV.WormData.STRATEGIES, default=WormCSV.WormData.DEFAULT_STRATEGY)
+    parser.add_argument('--fields', default='', help='comma-separated fields to collect (default: all)')
+    parser.add_argument('--latency', type=float, default=20.0, help='milliseconds the mock takes to answer')
+    parser.add_argument('--jitter', type=float, default=5.0, help='milliseconds the latency varies by, either way')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share (0 to 1) of requests answered with a 503')
+    parser.add_argument('--retry-after', type=float, help='seconds to send in a Retry-After header with each 503')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='share (0 to 1) of requests that are slow')
+    parser.add_argument('--slow-latency', type=float, help='milliseconds a slow request takes (default ten times --latency)')
+    parser.add_argument('--proteins', type=int, default=WormMock.MockWormBase.DEFAULT_PROTEINS,
+                        help='proteins per gene, each of which costs a best_human_match request')
+    parser.add_argument('--fixtures', help='a JSON file of data to serve per endpoint, laid out like '
+                        'WormMock.MockWormBase.DEFAULT_FIXTURES')
+    parser.add_argument('--startup', action='store_true', help='time how long WormBait takes to start, instead of '
+                        'benchmarking runs')
+    parser.add_argument('--startup-runs', type=int, default=10, help='fresh interpreters started per entry point '
+                        'by --startup')
+    parser.add_argument('--max-startup-ms', type=float, help='with --startup, fail if the median import time of any '
+                        'entry point is more than this')
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not print results')
+    return parser, parser.parse_args(argv)
+
+def pointAt (root):
+    """Sends every WormBase request made by WormData to the API at `root` instead"""
+    WormCSV.WormData.GENE_BASE = root + '/rest/field/gene'
+    WormCSV.WormData.PROTEIN_BASE = root + '/rest/field/protein'
+    WormCSV.WormData.WIDGET_BASE = root + '/rest/widget/gene'
+
+def percentiles (values):
+    """Summarises a list of seconds as milliseconds at the 50th, 90th and 99th percentiles, plus the maximum"""
+    if not values:
+        return None
+    values = sorted(values)
+    summary = {}
+    for name, p in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99)]:
+        summary[name] = round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 2)
+    summary['max'] = round(values[-1] * 1000, 2)
+    return summary
+
+def benchmark (mock, size, args, fields, outputPath):
+    """Performs one run over `size` genes against the mock and returns its results as a dict"""
+    ids = ['WBGene%08d' % i for i in range(1, size + 1)]
+    transport = WormNet.Transport()
+    runStats = WormRun.RunStats()
+    run = WormRun.WormBaitRun(ids, None, args.workers, args.backend, args.concurrency, transport,
+                              fields=fields, strategy=args.strategy, stats=runStats)
+    mock.reset()
+
+    start = time.time()
+    output = WormCSV.OutputCSV(outputPath, run.headers())
+    output.start(run.hasDbIds())
+    try:
+        for wormData in run.results():
+            output.writeRow(wormData)
+    finally:
+        output.finish()
+        transport.close()
+    seconds = time.time() - start
+    runStats.finish()
+
+    # The mock's view of the run (what it served) goes alongside WormBait's own
+    # (what each endpoint cost, retries and limiter waits included)
+    stats = mock.stats()
+    return {'genes': size,
+            'backend': run.backend,
+            'seconds': round(seconds, 3),
+            'genesPerSecond': round(size / seconds, 2),
+            'requests': stats['requests'],
+            'requestsPerSecond': round(stats['requests'] / seconds, 2),
+            'requestsPerGene': round(stats['requests'] / float(size), 2),
+            'byEndpoint': stats['byEndpoint'],
+            'bytes': stats['bytes'],
+            'errorsInjected': stats['errors'],
+            'failures': len(run.failures),
+            'finalRequestLimit': transport.limiter.currentLimit(),
+            'serviceLatencyMs': percentiles(stats['serviceTimes']),
+            'client': runStats.summary()}
+
+def startup (module, runs):
+    """Imports `module` in `runs` fresh interpreters and returns the timings as a dict
+
+    Each interpreter starts in this script's folder, as WormBait does, and with
+    nothing imported beforehand, so the caches of an already running process
+    don't flatter the result. The operating system's file cache still applies,
+    so the first run is reported on its own as 'firstMs'.
+    """
+    here = os.path.dirname(os.path.realpath(__file__))
+    importTimes = []
+    processTimes = []
+    deferred = set()
+    for i in range(runs):
+        start = time.time()
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT % (module, DEFERRED_MODULES)], cwd=here)
+        processTimes.append(time.time() - start)
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        importTimes.append(result['seconds'])
+        deferred.update(result['deferred'])
+
+    return {'module': module,
+            'runs': runs,
+            'firstMs': round(importTimes[0] * 1000, 2),
+            'importMs': percentiles(importTimes),
+            'processMs': percentiles(processTimes),
+            'deferredImported': sorted(deferred)}
+
+def mainStartup (args):
+    """Runs the --startup benchmark. Returns the exit status"""
+    report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+              'settings': dict(vars(args)), 'startup': []}
+    status = 0
+    for module in STARTUP_MODULES:
+        result = startup(module, args.startup_runs)
+        report['startup'].append(result)
+        if not args.quiet:
+            sys.stderr.write('%-12s import p50 %7.1f ms (first %.1f ms), whole process p50 %7.1f ms\n' %
+                             (module, result['importMs']['p50'], result['firstMs'], result['processMs']['p50']))
+
+        if result['deferredImported']:
+            sys.stderr.write('%s imported %s at startup; these should only be imported when first needed\n' %
+                             (module, ', '.join(result['deferredImported'])))
+            status = 1
+        if args.max_startup_ms is not None and result['importMs']['p50'] > args.max_startup_ms:
+            sys.stderr.write('%s took %.1f ms to import, more than the %.1f ms allowed\n' %
+                             (module, result['importMs']['p50'], args.max_startup_ms))
+            status = 1
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    if not args.quiet:
+        sys.stderr.write('Report written to ' + args.report + '\n')
+    return status
+
+def main (argv=None):
+    """Runs the benchmark described by the command line. Returns the exit status"""
+    parser, args = parseArguments(argv)
+    if args.startup:
+        return mainStartup(args)
+
+    try:
+        sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+        fields = WormRun.parse_fields(args.fields)
+    except ValueError as e:
+        parser.error(str(e))
+
+    fixtures = None
+    if args.fixtures:
+        with open(args.fixtures, 'r') as f:
+            fixtures = json.load(f)
+
+    mock = WormMock.MockWormBase(args.latency / 1000.0, args.jitter / 1000.0, args.error_rate, args.retry_after,
+                                 args.slow_rate, args.slow_latency and args.slow_latency / 1000.0,
+                                 fixtures, args.proteins)
+    pointAt(mock.startProcess())
+
+    settings = dict(vars(args))
+    settings['fields'] = fields
+    report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+              'settings': settings, 'runs': []}
+
+    outputDir = tempfile.mkdtemp(prefix='wormbaitbench')
+    try:
+        for size in sizes:
+            result = benchmark(mock, size, args, fields, os.path.join(outputDir, 'output.csv'))
+            report['runs'].append(result)
+            if not args.quiet:
+                sys.stderr.write('%6d genes: %8.2f genes/s, %7d requests (%.1f/gene), p50 %s ms, p99 %s ms, '
+                                 '%d failures\n' % (size, result['genesPerSecond'], result['requests'],
+                                                    result['requestsPerGene'], result['serviceLatencyMs']['p50'],
+                                                    result['serviceLatencyMs']['p99'], result['failures']))
+    finally:
+        mock.stop()
+        if os.path.exists(os.path.join(outputDir, 'output.csv')):
+            os.remove(os.path.join(outputDir, 'output.csv'))
+        os.rmdir(outputDir)
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    if not args.quiet:
+        sys.stderr.write('Report written to ' + args.report + '\n')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
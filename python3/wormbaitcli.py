@@ -0,0 +1,209 @@
+#!/usr/bin/python
+
+import argparse
+import sys
+import WormCSV
+import WormRun
+import WormNet
+import WormCache
+import WormDB
+
+"""This script performs a WormBait run from the command line, without the user interface.
+
+It runs exactly the same collection as the Process button, but takes its IDs
+from a file or standard input and never imports tkinter, so it can be used on
+headless machines and in scripts. Progress is reported on standard error, which
+leaves standard output free for the CSV when the output path is '-'.
+
+Example:
+    ./wormbaitcli.py ids.txt --database gene_exp.csv --output results.csv
+    cat ids.txt | ./wormbaitcli.py - --output - | sort
+"""
+
+def parseArguments (argv):
+    """Builds the command line parser and parses argv"""
+    parser = argparse.ArgumentParser(description='Collect data from WormBase for a list of IDs, without the WormBait window.')
+    parser.add_argument('ids', help="file holding the DB IDs, separated by newlines, commas or spaces ('-' for standard input)")
+    parser.add_argument('-d', '--database', help='the CuffLink database file. Not needed if every ID is a WormBase gene ID')
+    parser.add_argument('-o', '--output', required=True, help="the output CSV file ('-' for standard output), or a "
+                        "SQLite database if it ends in " + ', '.join(WormDB.SUFFIXES))
+    parser.add_argument('--fields', default='',
+                        help='comma-separated fields to collect (default: all). Choose from ' +
+                        ', '.join(WormCSV.WormData.FIELDS))
+    parser.add_argument('--strategy', choices=WormCSV.WormData.STRATEGIES, default=WormCSV.WormData.DEFAULT_STRATEGY,
+                        help="'widgets' collects several gene fields per request where WormBase allows it; "
+                        "'fields' makes one request per field")
+    parser.add_argument('--workers', type=int, default=WormRun.WormBaitRun.DEFAULT_WORKERS,
+                        help='genes collected at once by the threads backend')
+    parser.add_argument('--backend', choices=WormRun.WormBaitRun.BACKENDS, default='threads')
+    parser.add_argument('--concurrency', type=int, default=WormNet.AsyncFetcher.DEFAULT_CONCURRENCY,
+                        help='requests in flight at once on the asyncio backend')
+    parser.add_argument('--per-host', type=int, help='the most connections open to WormBase at once')
+    parser.add_argument('--connect-timeout', type=float, help='seconds to wait for a connection')
+    parser.add_argument('--read-timeout', type=float, help='seconds to wait for WormBase to answer')
+    parser.add_argument('--attempts', type=int, default=WormNet.RetryPolicy.DEFAULT_ATTEMPTS,
+                        help='the most times a request is tried')
+    parser.add_argument('--deadline', type=float, default=WormNet.RetryPolicy.DEFAULT_DEADLINE,
+                        help='seconds a request may take in total, across every attempt')
+    parser.add_argument('--hedge', action='store_true',
+                        help='send a duplicate of any request slower than 95%% of recent ones')
+    parser.add_argument('--cache', default='wormBaitCache.sqlite', help="the response cache file ('' for no cache)")
+    parser.add_argument('--cache-mode', choices=WormCache.ResponseCache.MODES, default='use')
+    parser.add_argument('--journal', help="the run journal, for resuming an interrupted run. Defaults to the output "
+                        "path plus '.journal' ('' for none)")
+    parser.add_argument('--incremental', action='store_true',
+                        help='reuse the rows of an existing output file and only fetch genes missing from it')
+    parser.add_argument('--max-age', type=float, help='with --incremental, the oldest (in days) the existing output may be')
+    parser.add_argument('--report', help="where to write the JSON run report. Defaults to the output path plus "
+                        "'.report.json' ('' for none)")
+    parser.add_argument('--profile', action='store_true',
+                        help="profile the run, saving the stats to the output path plus '.prof' and a summary "
+                        "to the output path plus '.profile.txt'")
+    parser.add_argument('--profile-top', type=int, default=WormRun.RunProfiler.DEFAULT_TOP,
+                        help='functions listed in each table of the profile summary')
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not report progress')
+    return parser, parser.parse_args(argv)
+
+def readIds (path):
+    """Reads and scrubs the IDs from the file at `path`, or from standard input if `path` is '-'"""
+    if path == '-':
+        return WormRun.collect_db_ids(sys.stdin.read())
+
+    with open(path, 'r') as f:
+        return WormRun.collect_db_ids(f.read())
+
+def main (argv=None):
+    """Performs a WormBait run as described by the command line, profiling it if asked to. Returns the exit status"""
+    parser, args = parseArguments(argv)
+    if not args.profile:
+        return perform(parser, args)
+
+    # Everything is profiled, reading the IDs and the database included. With
+    # the output on standard output, the profile goes in the current directory
+    profiler = WormRun.RunProfiler()
+    profiler.start()
+    try:
+        return perform(parser, args)
+    finally:
+        profiler.stop()
+        profilePath, summaryPath = profiler.save(args.output if args.output != '-' else 'wormbaitcli', args.profile_top)
+        if not args.quiet:
+            sys.stderr.write('Profile written to %s (summary in %s)\n' % (profilePath, summaryPath))
+
+def perform (parser, args):
+    """Performs the WormBait run described by the parsed command line `args`. Returns the exit status"""
+    def log (text):
+        if not args.quiet:
+            sys.stderr.write(text + '\n')
+            sys.stderr.flush()
+
+    cleanIds = readIds(args.ids)
+    if not cleanIds:
+        parser.error('no IDs were found in ' + args.ids)
+
+    try:
+        fields = WormRun.parse_fields(args.fields)
+    except ValueError as e:
+        parser.error(str(e))
+
+    noDbMode = WormRun.check_db_ids(cleanIds)
+    if not noDbMode and not args.database:
+        parser.error('a database file (--database) is needed unless every ID is a WormBase gene ID')
+
+    try:
+        transport = WormNet.Transport(perHost=args.per_host, connectTimeout=args.connect_timeout,
+                                      readTimeout=args.read_timeout,
+                                      retry=WormNet.RetryPolicy(args.attempts, deadline=args.deadline, hedge=args.hedge))
+    except ValueError as e:
+        parser.error(str(e))
+    cache = None
+    if args.cache:
+        cache = WormCache.ResponseCache(args.cache, mode=args.cache_mode)
+
+    database = None
+    if not noDbMode:
+        log('Database file located at: ' + args.database)
+        database = WormCSV.openDatabase(args.database)
+
+    journalPath = args.journal
+    if journalPath is None and args.output != '-':
+        journalPath = args.output + '.journal'
+    journal = None
+    if journalPath:
+        journal = WormRun.RunJournal(journalPath, cleanIds, fields, None if noDbMode else args.database)
+        if journal.completed:
+            log('Resuming: %d genes already collected by an earlier attempt' % len(journal.completed))
+
+    previous = None
+    if args.incremental and args.output != '-':
+        maxAge = None if args.max_age is None else args.max_age * 24 * 60 * 60
+        previous = WormCSV.openPreviousOutput(args.output, maxAge, fields)
+        log('Reusing %d rows from the existing output' % len(previous.rows))
+
+    stats = WormRun.RunStats()
+    run = WormRun.WormBaitRun(cleanIds, database, args.workers, args.backend, args.concurrency,
+                              transport, cache, journal=journal, previous=previous, fields=fields,
+                              strategy=args.strategy, stats=stats)
+
+    finished = [0]
+    def onFinished (id):
+        finished[0] += 1
+        log('%s ... finished (%d/%d, request limit %d)' % (id, finished[0], len(cleanIds),
+                                                            transport.limiter.currentLimit()))
+
+    log('Collecting data from WormBase for %d IDs' % len(cleanIds))
+    # An incremental run reads the output it is replacing, so the new one is
+    # staged beside it and only takes its place once the run is complete
+    output = WormCSV.openOutput(args.output, run.headers(), staged=previous is not None)
+    output.start(run.hasDbIds())
+    complete = False
+    try:
+        try:
+            for wormData in run.results(onFinished):
+                output.writeRow(wormData)
+            complete = not run.cancelled
+        finally:
+            output.finish(complete)
+    except:
+        if journal:
+            journal.close()
+        raise
+    else:
+        # The last rows only reach the output in finish(), so the journal is
+        # kept until that has succeeded
+        if journal and complete:
+            journal.remove()
+        elif journal:
+            journal.close()
+        if previous and complete:
+            previous.keepAge(args.output)
+    finally:
+        if database:
+            database.close()
+        if cache:
+            cache.close()
+        transport.close()
+
+    stats.finish()
+    for line in stats.lines():
+        log(line)
+
+    reportPath = args.report
+    if reportPath is None and args.output != '-':
+        reportPath = args.output + '.report.json'
+    if reportPath:
+        stats.write(reportPath, {'ids': len(cleanIds), 'backend': run.backend, 'strategy': args.strategy,
+                                 'fields': fields, 'failures': len(run.failures)})
+        log('Run report written to ' + reportPath)
+
+    for geneID, failure in run.failures:
+        log('Failed: %s %s/%s: %s' % (geneID, failure['id'], failure['endpoint'], failure['reason']))
+    if run.failures:
+        log('%d requests failed; their fields are blank in the output' % len(run.failures))
+
+    log('Run complete!')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 import os
 import sys
+import runpy
 
 """This script launches WormBait using the code compiled under Python2 or Python3.
 
@@ -9,6 +10,9 @@ the interest of cross-platform support, this launcher script determines the vers
 currently running and launches the appropriate WormBait for it. If the version
 cannot be determined, the launcher exits and prints an error message. 
 
+WormBait is run in this same interpreter, rather than a second one, so it starts
+sooner and always runs under the Python version that was checked here.
+
 Christopher Anna, 2/18/2016
 """
 
@@ -21,8 +25,13 @@ elif majorVersion == 2:
 
 if folder:
 	here = os.path.dirname(os.path.realpath(__file__))
+	script = os.path.join(here, folder, "wormbait.py")
 	print("Running " + folder + "/wormbait.py")
-	os.system("python " + str(here) +"/" + folder + "/wormbait.py")
+
+	# wormbait.py imports the rest of WormBait from its own folder
+	sys.path.insert(0, os.path.dirname(script))
+	sys.argv[0] = script
+	runpy.run_path(script, run_name="__main__")
 else:
 	print("WormBait could not determine your installed Python version")
 	